@@ -0,0 +1,389 @@
+# 离线压测：用伪造的 Update 驱动真实处理函数，数据库使用本地 Postgres，Telegram Bot 为桩对象。
+#
+#     DATABASE_URL=postgresql://localhost/ant_bench python bench.py --users 200 --concurrency 50 --runs 500
+#     DATABASE_URL=postgresql://localhost/ant_bench python bench.py --workers 1,2,4   # 多进程分片扩展性
+#
+# 请使用单独的测试库：压测用户ID从 BENCH_USER_BASE 开始，结束后会删除这些用户及其流水。
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+# 处理模块导入时读取收款地址，压测时给一个默认值
+os.environ.setdefault("USDT_RECHARGE_ADDRESS", "TBenchRechargeAddress000000000000")
+
+from psycopg2.extras import execute_values
+from telegram import Update
+from telegram.ext import ApplicationBuilder, ExtBot
+
+import cache_sync
+import metrics
+from db import init_pool, close_pool, get_connection, set_run_inline, CACHE_NOTIFY
+from migrations import run_migrations
+from update_processor import UserOrderedUpdateProcessor
+from trongrid import Transfer, MICRO_UNITS
+from handlers.recharge import match_transfers, RECHARGE_ADDRESS
+from main import add_handlers
+
+# 压测用户ID区间（远大于真实 Telegram 用户ID）
+BENCH_USER_BASE = 10**12
+BENCH_BALANCE = 10**9
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "AntBench", "username": "ant_bench_bot"}
+
+# 每个流程按顺序发送的更新：("command" | "callback" | "text", 内容)
+FLOWS = {
+    "start": lambda run, peer, hot: [("command", "/start")],
+    "profile": lambda run, peer, hot: [("callback", "profile")],
+    "exchange": lambda run, peer, hot: [
+        ("callback", "exchange"), ("callback", "usdt_to_cny"), ("text", "1"),
+    ],
+    "transfer": lambda run, peer, hot: [
+        ("callback", "transfer"), ("callback", "transfer_usdt"), ("text", "0.01"),
+        ("text", f"@bench_{peer}"), ("callback", "confirm_transfer"),
+    ],
+    # 所有用户转给同一个账户（不参与其他流程），测试热点行锁竞争
+    "transfer_hot": lambda run, peer, hot: [
+        ("callback", "transfer"), ("callback", "transfer_usdt"), ("text", "0.01"),
+        ("text", f"@bench_{hot}"), ("callback", "confirm_transfer"),
+    ],
+    # 每次使用不同的基础金额，避免占满同一金额的尾数槽位
+    "recharge": lambda run, peer, hot: [
+        ("callback", "recharge"), ("callback", "recharge_usdt"), ("text", str(100 + run)),
+    ],
+}
+
+
+# Telegram Bot 桩：不发网络请求，按接口返回最小的合法结果，并统计调用次数
+class StubBot(ExtBot):
+    def __init__(self, *args, api_latency=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Bot 初始化后属性被冻结
+        with self._unfrozen():
+            self.api_latency = api_latency
+            self.api_calls = Counter()
+            self._message_ids = itertools.count(1000)
+
+    async def _do_post(self, endpoint, data, *args, **kwargs):
+        self.api_calls[endpoint] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        if endpoint == "getMe":
+            return dict(BOT_USER, can_join_groups=False, can_read_all_group_messages=False, supports_inline_queries=False)
+        if endpoint in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            chat_id = int(data.get("chat_id") or 0)
+            message = {
+                "message_id": data.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": data.get("text") or "",
+            }
+            if endpoint == "sendPhoto":
+                message["photo"] = [{"file_id": "bench-photo", "file_unique_id": "bench-photo", "width": 200, "height": 200}]
+            return message
+        return True
+
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_ids = itertools.count(1)
+
+    def build(self, user_id, kind, payload):
+        user = {"id": user_id, "is_bot": False, "first_name": "bench", "username": f"bench_{user_id - BENCH_USER_BASE}"}
+        chat = {"id": user_id, "type": "private"}
+        update_id = next(self.update_ids)
+        if kind == "callback":
+            # 菜单消息固定为每个用户的 1 号消息，和真实会话一样反复编辑同一条消息
+            menu = {"message_id": 1, "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": "menu"}
+            data = {"callback_query": {
+                "id": str(update_id), "from": user, "chat_instance": str(user_id), "data": payload, "message": menu,
+            }}
+        else:
+            message = {"message_id": update_id + 1, "date": int(time.time()), "chat": chat, "from": user, "text": payload}
+            if kind == "command":
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(payload.split()[0])}]
+            data = {"message": message}
+        return Update.de_json(dict(data, update_id=update_id), self.bot)
+
+
+def seed_users(count):
+    rows = [(BENCH_USER_BASE + i, f"bench_{i}", BENCH_BALANCE, BENCH_BALANCE) for i in range(count)]
+    with get_connection() as conn, conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO users (user_id, username, usdt_balance, cny_balance) VALUES %s
+            ON CONFLICT (user_id) DO UPDATE
+            SET username = EXCLUDED.username, usdt_balance = EXCLUDED.usdt_balance, cny_balance = EXCLUDED.cny_balance
+        """, rows)
+
+
+def cleanup(count):
+    bounds = (BENCH_USER_BASE, BENCH_USER_BASE + count)
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM transactions WHERE user_id >= %s AND user_id < %s", bounds)
+        cur.execute("DELETE FROM recharge_orders WHERE user_id >= %s AND user_id < %s", bounds)
+        cur.execute("DELETE FROM notification_outbox WHERE chat_id >= %s AND chat_id < %s", bounds)
+        cur.execute("DELETE FROM users WHERE user_id >= %s AND user_id < %s", bounds)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# 跑一个流程：concurrency 个并发会话，每个会话只使用 users 中自己的一组用户，
+# 避免同一用户的两个流程交错写入会话状态；run_offset 区分不同进程的执行序号
+async def run_flow(app, factory, flow, users, concurrency, runs, total_users, run_offset=0):
+    steps_for = FLOWS[flow]
+    update_latencies = []
+    flow_latencies = []
+    run_ids = itertools.count()
+
+    async def session(worker):
+        own_users = users[worker::concurrency]
+        for i in itertools.count():
+            run = next(run_ids)
+            if run >= runs:
+                return
+            index = own_users[i % len(own_users)]
+            user_id = BENCH_USER_BASE + index
+            peer = (index + 1) % total_users
+            flow_start = time.perf_counter()
+            for kind, payload in steps_for(run_offset + run, peer, total_users):
+                update = factory.build(user_id, kind, payload)
+                start = time.perf_counter()
+                await app.update_processor.process_update(update, app.process_update(update))
+                update_latencies.append(time.perf_counter() - start)
+            flow_latencies.append(time.perf_counter() - flow_start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(w) for w in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return elapsed, update_latencies, flow_latencies
+
+
+# 离线匹配基准：不访问数据库和网络，只测 match_transfers
+def bench_matcher(orders_count=10000, transfers_count=1000, repeats=20):
+    now = datetime.now()
+    orders = [
+        (f"order-{i}", BENCH_USER_BASE + i, Decimal(100 + i) + Decimal("0.01"), now, now + timedelta(minutes=30))
+        for i in range(orders_count)
+    ]
+    address = RECHARGE_ADDRESS.lower()
+    transfers = [
+        Transfer(f"tx-{i}", "USDT", address, (100 + i * 2) * MICRO_UNITS + MICRO_UNITS // 100, now, i)
+        for i in range(transfers_count)
+    ]
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        matches = match_transfers(orders, transfers, RECHARGE_ADDRESS)
+        timings.append(time.perf_counter() - start)
+    print(f"\nmatcher：{orders_count} 笔订单 × {transfers_count} 笔转账，匹配 {len(matches)} 笔，"
+          f"p50 {percentile(timings, 0.5) * 1000:.2f} ms，p99 {percentile(timings, 0.99) * 1000:.2f} ms")
+
+
+def print_header():
+    print(f"{'流程':<14}{'更新数':>8}{'更新/秒':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'流程p50':>10}{'流程p99':>10}{'错误':>6}")
+
+
+def print_row(flow, elapsed, update_latencies, flow_latencies, errors):
+    print(
+        f"{flow:<14}{len(update_latencies):>8}{len(update_latencies) / elapsed:>10.1f}"
+        f"{percentile(update_latencies, 0.5) * 1000:>10.2f}{percentile(update_latencies, 0.99) * 1000:>10.2f}"
+        f"{percentile(flow_latencies, 0.5) * 1000:>10.2f}{percentile(flow_latencies, 0.99) * 1000:>10.2f}"
+        f"{errors:>6}"
+    )
+
+
+# 一个进程（分片时为第 index 个工作进程）跑完所有流程：只使用 user_id 按 count 取模落在本进程的用户，
+# 与分片路由一致；返回 ({流程: (耗时, 更新延迟, 流程延迟, 错误数)}, API 调用次数)。
+# barrier 不为空时每个流程开始前等待所有进程就绪。
+# baseline 为 True 时复现改造前的处理方式：数据库调用在事件循环中同步执行，更新逐个处理
+async def run_worker(args, flows, index=0, count=1, barrier=None, on_result=None, baseline=False):
+    users = [i for i in range(args.users) if (BENCH_USER_BASE + i) % count == index]
+    concurrency = max(1, min(args.concurrency // count, len(users)))
+    runs = args.runs // count
+
+    bot = StubBot(token="0:bench", api_latency=args.api_latency_ms / 1000)
+    processor = UserOrderedUpdateProcessor(1 if baseline else concurrency)
+    app = ApplicationBuilder().bot(bot).concurrent_updates(processor).build()
+    add_handlers(app)
+    errors = Counter()
+    current = {"flow": None}
+
+    async def on_error(update, context):
+        errors[current["flow"]] += 1
+        if errors[current["flow"]] == 1:
+            print(f"⚠️ {current['flow']} 出错：{context.error!r}")
+    app.add_error_handler(on_error)
+
+    await app.initialize()
+    if CACHE_NOTIFY:
+        cache_sync.start_listener()
+    set_run_inline(baseline)
+    factory = UpdateFactory(bot)
+    results = {}
+    try:
+        for flow in flows:
+            current["flow"] = flow
+            if barrier is not None:
+                barrier.wait()
+            elapsed, update_latencies, flow_latencies = await run_flow(
+                app, factory, flow, users, concurrency, runs, args.users, run_offset=index * runs
+            )
+            results[flow] = (elapsed, update_latencies, flow_latencies, errors[flow])
+            if on_result is not None:
+                on_result(flow, *results[flow])
+    finally:
+        set_run_inline(False)
+        cache_sync.stop_listener()
+        await app.shutdown()
+    return results, bot.api_calls
+
+
+async def run_bench(args):
+    flows = [f for f in args.flows.split(",") if f in FLOWS]
+    if "matcher" in args.flows.split(","):
+        bench_matcher(args.orders, args.transfers)
+    if not flows:
+        return
+
+    init_pool()
+    run_migrations()
+    # 多建一个用户作为热点收款账户
+    seed_users(args.users + 1)
+
+    print(f"\n用户 {args.users}，并发 {args.concurrency}，每个流程 {args.runs} 次，API 延迟 {args.api_latency_ms} ms")
+    try:
+        if args.compare:
+            print("\n改造前（同步数据库调用，逐个处理更新）")
+            print_header()
+            before, _ = await run_worker(args, flows, on_result=print_row, baseline=True)
+            print("\n改造后")
+        print_header()
+        after, api_calls = await run_worker(args, flows, on_result=print_row)
+        if args.compare:
+            print(f"\n{'流程':<14}{'改造前/秒':>12}{'改造后/秒':>12}{'倍数':>8}")
+            for flow in flows:
+                rate_before = len(before[flow][1]) / before[flow][0]
+                rate_after = len(after[flow][1]) / after[flow][0]
+                print(f"{flow:<14}{rate_before:>12.1f}{rate_after:>12.1f}{rate_after / rate_before:>8.2f}")
+        print("\nTelegram API 调用：", dict(api_calls))
+        print("\n📊 处理函数指标\n" + metrics.render())
+    finally:
+        if not args.keep_data:
+            cleanup(args.users + 1)
+        close_pool()
+
+
+# 分片压测的工作进程入口（spawn 启动，数据库连接池在子进程内创建）
+def worker_process(args, flows, index, count, barrier, queue):
+    init_pool()
+    try:
+        results, api_calls = asyncio.run(run_worker(args, flows, index, count, barrier))
+        queue.put((index, results, dict(api_calls)))
+    except BaseException:
+        # 让其他进程不再等待，主进程收到 None 后中止
+        barrier.abort()
+        queue.put((index, None, None))
+        raise
+    finally:
+        close_pool()
+
+
+# 分片扩展性：依次用 1..N 个进程跑相同的总负载（用户、并发、次数按进程均分），
+# 每个进程各自的连接池、缓存和事件循环，缓存失效通过 NOTIFY 同步；
+# 吞吐 = 所有进程的更新总数 / 最慢进程的耗时
+def run_scaling(args):
+    flows = [f for f in args.flows.split(",") if f in FLOWS]
+    worker_counts = [int(n) for n in args.workers.split(",") if n.strip()]
+    init_pool()
+    run_migrations()
+    seed_users(args.users + 1)
+    close_pool()
+
+    ctx = multiprocessing.get_context("spawn")
+    throughput = {}
+    try:
+        for count in worker_counts:
+            # 子进程导入 db 时读取，决定是否开启缓存失效通知
+            os.environ["WORKER_COUNT"] = str(count)
+            barrier = ctx.Barrier(count)
+            queue = ctx.Queue()
+            processes = [
+                ctx.Process(target=worker_process, args=(args, flows, i, count, barrier, queue))
+                for i in range(count)
+            ]
+            for process in processes:
+                process.start()
+            outputs = [queue.get() for _ in processes]
+            for process in processes:
+                process.join()
+            if any(results is None for _, results, _ in outputs):
+                print(f"❌ {count} 个进程的压测中有进程出错，已中止")
+                return
+
+            print(f"\n{count} 个进程：用户 {args.users}，总并发 {args.concurrency}，每个流程 {args.runs} 次")
+            print_header()
+            api_calls = Counter()
+            for _, _, calls in outputs:
+                api_calls.update(calls)
+            for flow in flows:
+                per_worker = [results[flow] for _, results, _ in outputs]
+                elapsed = max(r[0] for r in per_worker)
+                update_latencies = [x for r in per_worker for x in r[1]]
+                flow_latencies = [x for r in per_worker for x in r[2]]
+                print_row(flow, elapsed, update_latencies, flow_latencies, sum(r[3] for r in per_worker))
+                throughput[flow, count] = len(update_latencies) / elapsed
+            print("Telegram API 调用：", dict(api_calls))
+    finally:
+        os.environ.pop("WORKER_COUNT", None)
+        if not args.keep_data:
+            init_pool()
+            cleanup(args.users + 1)
+            close_pool()
+
+    base = worker_counts[0]
+    print(f"\n扩展倍数（相对 {base} 个进程的更新/秒）")
+    print(f"{'流程':<14}" + "".join(f"{f'{n} 进程':>10}" for n in worker_counts))
+    for flow in flows:
+        print(f"{flow:<14}" + "".join(
+            f"{throughput[flow, n] / throughput[flow, base]:>10.2f}" for n in worker_counts
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ant 钱包机器人离线压测")
+    parser.add_argument("--flows", default=",".join(list(FLOWS) + ["matcher"]),
+                        help=f"逗号分隔：{', '.join(FLOWS)}, matcher")
+    parser.add_argument("--users", type=int, default=100, help="压测用户数")
+    parser.add_argument("--concurrency", type=int, default=20, help="并发会话数（不超过用户数）")
+    parser.add_argument("--runs", type=int, default=200, help="每个流程的执行次数")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="模拟 Telegram API 延迟")
+    parser.add_argument("--keep-data", action="store_true", help="结束后保留压测数据")
+    parser.add_argument("--compare", action="store_true",
+                        help="先按改造前的方式（同步数据库调用、逐个处理更新）跑一遍作对照")
+    parser.add_argument("--workers", help="分片扩展性：逗号分隔的进程数，如 1,2,4")
+    parser.add_argument("--orders", type=int, default=10000, help="matcher：待支付订单数")
+    parser.add_argument("--transfers", type=int, default=1000, help="matcher：链上转账数")
+    args = parser.parse_args()
+    args.users = max(args.users, 2)
+    args.concurrency = max(1, min(args.concurrency, args.users))
+    if args.workers:
+        if "matcher" in args.flows.split(","):
+            bench_matcher(args.orders, args.transfers)
+        run_scaling(args)
+    else:
+        asyncio.run(run_bench(args))
+
+
+if __name__ == "__main__":
+    main()
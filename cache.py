@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+# 缓存未命中标记（区分“未缓存”和“缓存了 None”）
+MISSING = object()
+
+
+# 线程安全的 LRU + TTL 缓存，带命中统计
+class TTLCache:
+    def __init__(self, maxsize, ttl, negative_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # None 结果（如用户不存在）的缓存时间，默认与 ttl 相同
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # 正在加载的键：key → [进行中的加载数, 版本]；加载期间该键失效时版本递增
+        self._loading = {}
+        # clear() 时递增，丢弃之前发起的所有加载结果
+        self._epoch = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            # 只影响该键正在进行的加载，其他键不受影响
+            loading = self._loading.get(key)
+            if loading is not None:
+                loading[1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    # 读穿：未命中时调用 loader 加载并写入缓存
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        return self.load(key, loader)
+
+    # 调用 loader 加载并写入缓存（调用方已确认未命中）
+    def load(self, key, loader):
+        with self._lock:
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            version = (self._epoch, loading[1])
+        try:
+            value = loader()
+        except BaseException:
+            with self._lock:
+                self._finish_load(key, loading)
+            raise
+        with self._lock:
+            self._finish_load(key, loading)
+            # 加载期间该键失效过，结果可能已过时，不写入缓存
+            if version == (self._epoch, loading[1]):
+                self._set(key, value, self.negative_ttl if value is None else self.ttl)
+        return value
+
+    def _finish_load(self, key, loading):
+        loading[0] -= 1
+        if loading[0] == 0 and self._loading.get(key) is loading:
+            del self._loading[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,84 @@
+import json
+import os
+import select
+import threading
+import psycopg2
+from psycopg2 import extensions
+from db import user_cache, username_cache, CACHE_CHANNEL
+
+# 等待通知的超时（秒），也是停止监听的最长延迟
+LISTEN_TIMEOUT = 1.0
+# 监听连接断开后的重连间隔（秒）
+RECONNECT_DELAY = 5.0
+
+_thread = None
+_stop = threading.Event()
+
+
+# 收到其他进程的失效通知：清除对应缓存项（正在进行的加载结果也会被丢弃）
+def apply_invalidation(payload):
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return
+    if data.get("pid") == os.getpid():
+        return  # 本进程写入时已失效
+    for user_id in data.get("users", ()):
+        user_cache.invalidate(user_id)
+    for username in data.get("usernames", ()):
+        username_cache.invalidate(username)
+
+
+def _connect():
+    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+    conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {CACHE_CHANNEL}")
+    return conn
+
+
+# 监听线程：单独的自动提交连接，不占用连接池
+def _listen():
+    conn = None
+    while not _stop.is_set():
+        try:
+            if conn is None:
+                conn = _connect()
+                # 断线期间可能漏掉通知，重新连上后清空缓存
+                user_cache.clear()
+                username_cache.clear()
+            if select.select([conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                apply_invalidation(conn.notifies.pop(0).payload)
+        except (psycopg2.Error, OSError) as e:
+            print("⚠️ 缓存失效监听断开，稍后重连:", e)
+            if conn is not None:
+                conn.close()
+                conn = None
+            # 监听中断期间不能保证缓存一致，先清空
+            user_cache.clear()
+            username_cache.clear()
+            _stop.wait(RECONNECT_DELAY)
+    if conn is not None:
+        conn.close()
+
+
+def start_listener():
+    global _thread
+    if _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_listen, name="cache-sync", daemon=True)
+    _thread.start()
+    print(f"🔄 缓存失效监听已启动（频道 {CACHE_CHANNEL}）")
+
+
+def stop_listener():
+    global _thread
+    if _thread is None:
+        return
+    _stop.set()
+    _thread.join(LISTEN_TIMEOUT * 2)
+    _thread = None
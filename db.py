@@ -1,33 +1,499 @@
+import asyncio
+import contextvars
+import functools
+import json
 import psycopg2
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal
+from psycopg2 import extensions, pool
 from dotenv import load_dotenv
+from cache import MISSING, TTLCache
+import metrics
 
 # 加载环境变量
 load_dotenv()
 
-# 连接数据库
+# 连接池配置
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# 连接空闲超过该秒数后，借出前先 SELECT 1 探活
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", "30"))
+
+# 用户信息缓存（username, usdt_balance, cny_balance）
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# 用户名 → user_id 缓存（键为小写用户名），不存在的用户名短时间负缓存
+USERNAME_CACHE_TTL = float(os.getenv("USERNAME_CACHE_TTL", "300"))
+USERNAME_NEGATIVE_TTL = float(os.getenv("USERNAME_NEGATIVE_TTL", "30"))
+username_cache = TTLCache(USER_CACHE_SIZE, USERNAME_CACHE_TTL, negative_ttl=USERNAME_NEGATIVE_TTL)
+# 命中率出现在指标日志和指标接口中，用于调整缓存大小
+metrics.register_stats("cache.user_cache", user_cache.stats)
+metrics.register_stats("cache.username_cache", username_cache.stats)
+
+# 多进程部署（分片）时缓存各自独立：写入后通过 Postgres NOTIFY 通知其他进程失效
+# （cache_sync.py 监听），通知随事务提交送达。WORKER_COUNT > 1 时默认开启
+CACHE_CHANNEL = "cache_invalidation"
+CACHE_NOTIFY = os.getenv(
+    "CACHE_NOTIFY", "true" if int(os.getenv("WORKER_COUNT", "1")) > 1 else "false"
+).lower() == "true"
+
+# 余额字段白名单（列名无法参数化）
+BALANCE_COLUMNS = {"usdt": "usdt_balance", "cny": "cny_balance"}
+
+# 历史记录类型 → (表名, 交易类型)
+HISTORY_KINDS = {
+    "recharge": ("transactions", "recharge"),
+    "withdraw": ("transactions", "withdraw"),
+    "transfer": ("transactions", "transfer"),
+    "redpacket": ("red_packets", None),
+    "escrow": ("transactions", "escrow"),
+}
+
+# 转账时转出方或接收方账户不存在（与余额不足的 None 区分）
+ACCOUNT_NOT_FOUND = "account_not_found"
+
+# 充值尾数：每个基础金额有 0.01 ~ 0.99 共 99 个槽位
+CENT = Decimal("0.01")
+SUFFIX_SLOTS = range(1, 100)
+
+_pool = None
+_pool_lock = threading.Lock()
+# 连接池满时阻塞等待，而不是直接抛出 PoolError
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = {}
+# 数据库线程池：线程数不超过连接池上限，事件循环只等待结果
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+# 统计每次查询（计入当前更新的查询次数与耗时）
+class CountingCursor(extensions.cursor):
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(time.perf_counter() - start)
+
+# 初始化连接池（进程内只创建一次）
+def init_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = pool.ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX, os.getenv("DATABASE_URL"), cursor_factory=CountingCursor
+            )
+    return _pool
+
+# 关闭连接池
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+# 借出前的健康检查
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    try:
+        status = conn.get_transaction_status()
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        if time.monotonic() - _last_used.get(id(conn), 0) > DB_POOL_PING_IDLE:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+# 从连接池借出一个可用连接
+def _checkout():
+    db_pool = init_pool()
+    _pool_slots.acquire()
+    try:
+        # 坏连接直接丢弃，最多重试 DB_POOL_MAX + 1 次
+        for _ in range(DB_POOL_MAX + 1):
+            conn = db_pool.getconn()
+            if _is_healthy(conn):
+                return db_pool, conn
+            _last_used.pop(id(conn), None)
+            db_pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("无法从连接池获取可用的数据库连接")
+    except BaseException:
+        _pool_slots.release()
+        raise
+
+# 为 True 时 run_db 直接在事件循环中同步执行（bench.py --compare 的对照组，复现改造前的阻塞调用）
+_run_inline = False
+
+def set_run_inline(enabled):
+    global _run_inline
+    _run_inline = enabled
+
+# 在线程池中执行同步数据库函数，避免阻塞事件循环；
+# 复制当前上下文，数据库线程中的查询计入发起它的更新
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    start = time.perf_counter()
+    try:
+        if _run_inline:
+            return func(*args, **kwargs)
+        return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+    finally:
+        metrics.observe(f"db.{getattr(func, '__qualname__', 'call')}", time.perf_counter() - start)
+
+# 连接上下文：正常退出时提交，异常时回滚，最后归还连接池
+@contextmanager
 def get_connection():
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
-
-# 获取用户信息
-def get_user_info(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT username, usdt_balance, cny_balance FROM users WHERE user_id = %s", (user_id,))
-    user_info = cur.fetchone()
-    cur.close()
-    conn.close()
-    return user_info
-
-# 插入用户信息（首次启动时）
+    db_pool, conn = _checkout()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        broken = broken or bool(conn.closed)
+        if broken:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+        db_pool.putconn(conn, close=broken)
+        _pool_slots.release()
+
+# 在当前事务内发布缓存失效通知（user_cache 的 user_id、username_cache 的用户名）
+def _notify_invalidation(cur, user_ids=(), usernames=()):
+    if not CACHE_NOTIFY:
+        return
+    payload = {
+        "pid": os.getpid(),
+        "users": list(user_ids),
+        "usernames": [normalize_username(u) for u in usernames if u],
+    }
+    cur.execute("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, json.dumps(payload)))
+
+# 异步获取用户信息（读穿缓存，余额变动时失效）：缓存命中时直接返回，不占用数据库线程
+async def fetch_user_info(user_id):
+    user_info = user_cache.get(user_id)
+    if user_info is not MISSING:
+        return user_info
+    return await run_db(user_cache.load, user_id, lambda: _load_user_info(user_id))
+
+def _load_user_info(user_id):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT username, usdt_balance, cny_balance FROM users WHERE user_id = %s", (user_id,))
+        return cur.fetchone()
+
+# 注册或更新用户（首次启动时插入，用户名变化时更新），一条语句返回最新用户信息
 def add_user_to_db(user_id, username):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO users (user_id, username, usdt_balance, cny_balance) 
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (user_id) DO NOTHING;
-    """, (user_id, username, 0.00, 0.00))  # 初始余额为 0
-    conn.commit()
-    cur.close()
-    conn.close()
+    def upsert():
+        user_info, previous_username = _upsert_user(user_id, username)
+        # 同步刷新用户名解析缓存：旧用户名失效，新用户名直接命中
+        if previous_username and previous_username != username:
+            username_cache.invalidate(normalize_username(previous_username))
+        if username:
+            username_cache.set(normalize_username(username), user_id)
+        return user_info
+    return user_cache.load(user_id, upsert)
+
+# 返回 (最新用户信息, 更新前的用户名)
+def _upsert_user(user_id, username):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            WITH previous AS (
+                SELECT username FROM users WHERE user_id = %(user_id)s
+            ), upserted AS (
+                INSERT INTO users (user_id, username, usdt_balance, cny_balance)
+                VALUES (%(user_id)s, %(username)s, 0, 0)
+                ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
+                WHERE users.username IS DISTINCT FROM EXCLUDED.username
+                RETURNING username, usdt_balance, cny_balance
+            )
+            SELECT username, usdt_balance, cny_balance, (SELECT username FROM previous), TRUE FROM upserted
+            UNION ALL
+            SELECT username, usdt_balance, cny_balance, username, FALSE FROM users
+            WHERE user_id = %(user_id)s AND NOT EXISTS (SELECT 1 FROM upserted)
+        """, {"user_id": user_id, "username": username})  # 初始余额为 0
+        row = cur.fetchone()
+        # 新用户或用户名变化：其他进程的用户信息、新旧用户名（含负缓存）失效
+        if row and row[4]:
+            _notify_invalidation(cur, [user_id], [username, row[3]])
+    if not row:
+        return None, None
+    return row[:3], row[3]
+
+# 异步注册用户：缓存中用户名未变化时无需访问数据库
+async def ensure_user(user_id, username):
+    user_info = user_cache.get(user_id)
+    if user_info is not MISSING and user_info is not None and user_info[0] == username:
+        return user_info
+    return await run_db(add_user_to_db, user_id, username)
+
+# 用户名统一为小写、去掉 @，Telegram 用户名不区分大小写
+def normalize_username(username):
+    return username.strip().lstrip("@").lower()
+
+def _load_user_id(key):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT user_id FROM users WHERE lower(username) = %s ORDER BY user_id LIMIT 1", (key,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+# 异步解析用户名（不区分大小写，带正/负缓存）：缓存命中时直接返回，不占用数据库线程
+async def resolve_username(username):
+    key = normalize_username(username)
+    user_id = username_cache.get(key)
+    if user_id is not MISSING:
+        return user_id
+    return await run_db(username_cache.load, key, lambda: _load_user_id(key))
+
+# 兑换：余额充足时扣减一种余额并增加另一种余额，返回最新用户信息；余额不足返回 None
+def exchange_balance(user_id, from_currency, amount, to_currency, to_amount):
+    from_col = BALANCE_COLUMNS[from_currency]
+    to_col = BALANCE_COLUMNS[to_currency]
+    amount, to_amount = Decimal(str(amount)), Decimal(str(to_amount))
+    if amount <= 0:
+        raise ValueError("兑换金额必须大于 0")
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE users SET {from_col} = {from_col} - %(amount)s, {to_col} = {to_col} + %(to_amount)s
+            WHERE user_id = %(user_id)s AND {from_col} >= %(amount)s
+            RETURNING username, usdt_balance, cny_balance
+        """, {"amount": amount, "to_amount": to_amount, "user_id": user_id})
+        row = cur.fetchone()
+        if row:
+            _notify_invalidation(cur, [user_id])
+    user_cache.invalidate(user_id)
+    return row
+
+# 转账：按 user_id 顺序锁定双方，条件扣减转出方余额、增加接收方余额，写入交易记录和
+# 给接收方的通知（notify_text），全部在同一事务内完成。返回转出方最新余额；
+# 余额不足返回 None，账户不存在返回 ACCOUNT_NOT_FOUND
+def transfer_balance(from_user_id, to_user_id, currency, amount, notify_text=None):
+    col = BALANCE_COLUMNS[currency]
+    amount = Decimal(str(amount))
+    if amount <= 0:
+        raise ValueError("转账金额必须大于 0")
+    if from_user_id == to_user_id:
+        raise ValueError("不能转账给自己")
+    with get_connection() as conn, conn.cursor() as cur:
+        # 固定加锁顺序，避免双向并发转账死锁
+        cur.execute(
+            "SELECT user_id FROM users WHERE user_id IN (%s, %s) ORDER BY user_id FOR UPDATE",
+            (from_user_id, to_user_id)
+        )
+        if len(cur.fetchall()) != 2:
+            conn.rollback()
+            return ACCOUNT_NOT_FOUND
+
+        cur.execute(
+            f"UPDATE users SET {col} = {col} - %(amount)s WHERE user_id = %(user_id)s AND {col} >= %(amount)s RETURNING {col}",
+            {"amount": amount, "user_id": from_user_id}
+        )
+        row = cur.fetchone()
+        if not row:
+            conn.rollback()
+            return None
+
+        cur.execute(f"""
+            WITH credited AS (
+                UPDATE users SET {col} = {col} + %(amount)s WHERE user_id = %(to_user_id)s RETURNING user_id
+            ), logged AS (
+                INSERT INTO transactions (user_id, transaction_type, amount, timestamp)
+                SELECT %(from_user_id)s, 'transfer', %(amount)s, NOW() FROM credited
+            )
+            INSERT INTO notification_outbox (chat_id, text)
+            SELECT user_id, %(notify_text)s FROM credited WHERE %(notify_text)s IS NOT NULL
+        """, {"amount": amount, "to_user_id": to_user_id, "from_user_id": from_user_id, "notify_text": notify_text})
+        _notify_invalidation(cur, [from_user_id, to_user_id])
+    user_cache.invalidate(from_user_id)
+    user_cache.invalidate(to_user_id)
+    return row[0]
+
+# 历史记录分页：cursor 为 (timestamp, id)，direction 为 older / newer
+# 返回 (按时间倒序的记录 [(id, amount, timestamp)], 是否有更早记录, 是否有更新记录)
+def get_history_page(user_id, kind, cursor=None, direction="older", limit=10):
+    table, transaction_type = HISTORY_KINDS[kind]
+    older = direction == "older"
+    params = {"user_id": user_id, "transaction_type": transaction_type, "limit": limit + 1}
+    conditions = ["user_id = %(user_id)s"]
+    if transaction_type:
+        conditions.append("transaction_type = %(transaction_type)s")
+    if cursor:
+        params["ts"], params["id"] = cursor
+        conditions.append(f"(timestamp, id) {'<' if older else '>'} (%(ts)s, %(id)s)")
+    order = "DESC" if older else "ASC"
+
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT id, amount, timestamp FROM {table}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY timestamp {order}, id {order} LIMIT %(limit)s
+        """, params)
+        rows = cur.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if older:
+        return rows, has_more, cursor is not None
+    rows.reverse()
+    return rows, True, has_more
+
+# 插入充值订单：为基础金额分配一个待支付订单中唯一的实付金额，槽位用尽时返回 None
+def create_recharge_order(order_id, user_id, amount_input, address):
+    base = Decimal(str(amount_input)).quantize(CENT)
+    low, high = base + CENT * SUFFIX_SLOTS[0], base + CENT * SUFFIX_SLOTS[-1]
+    with get_connection() as conn, conn.cursor() as cur:
+        # 先释放该区间内已超时但尚未清理的槽位
+        cur.execute("""
+            UPDATE recharge_orders SET status = 'expired'
+            WHERE status = 'pending' AND expires_at < NOW() AND amount_real BETWEEN %s AND %s
+        """, (low, high))
+        cur.execute("""
+            SELECT amount_real FROM recharge_orders
+            WHERE status = 'pending' AND amount_real BETWEEN %s AND %s
+        """, (low, high))
+        taken = {row[0] for row in cur.fetchall()}
+
+        free = [base + CENT * i for i in SUFFIX_SLOTS if base + CENT * i not in taken]
+        random.shuffle(free)
+        # 并发下槽位可能被抢占，由唯一索引兜底，冲突时换下一个
+        for amount_real in free:
+            cur.execute("""
+                INSERT INTO recharge_orders (order_id, user_id, amount_input, amount_real, address, created_at, expires_at, status)
+                VALUES (%s, %s, %s, %s, %s, NOW(), NOW() + INTERVAL '30 minutes', 'pending')
+                ON CONFLICT (amount_real) WHERE status = 'pending' DO NOTHING
+                RETURNING amount_real
+            """, (order_id, user_id, amount_input, amount_real, address))
+            if cur.fetchone():
+                return amount_real
+    return None
+
+# 查询待支付订单
+def get_pending_orders():
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT order_id, user_id, amount_real, created_at, expires_at
+            FROM recharge_orders
+            WHERE status = 'pending'
+        """)
+        return cur.fetchall()
+
+# 过滤掉已入账的交易ID
+def filter_unprocessed_txids(txids):
+    if not txids:
+        return set()
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT txid FROM processed_transactions WHERE txid = ANY(%s)", (list(txids),))
+        processed = {row[0] for row in cur.fetchall()}
+    return set(txids) - processed
+
+# 成功到账处理：登记交易ID、订单 pending→success、加余额、写入到账通知在同一事务内完成
+# notify_template 可使用 {amount} 和 {order_id}
+def complete_recharge(order_id, txid, notify_template=None):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO processed_transactions (txid, order_id) VALUES (%s, %s)
+            ON CONFLICT (txid) DO NOTHING
+            RETURNING txid
+        """, (txid, order_id))
+        if not cur.fetchone():
+            return False  # 该交易已入账
+
+        # 只有仍为 pending 的订单才能入账
+        cur.execute("""
+            UPDATE recharge_orders SET status = 'success'
+            WHERE order_id = %s AND status = 'pending'
+            RETURNING user_id, amount_input
+        """, (order_id,))
+        row = cur.fetchone()
+        if not row:
+            conn.rollback()  # 订单已处理或已过期，不消耗该交易
+            return False
+
+        user_id, input_amt = row
+
+        # 增加余额
+        cur.execute("UPDATE users SET usdt_balance = usdt_balance + %s WHERE user_id = %s", (input_amt, user_id))
+
+        # 写入交易记录
+        cur.execute("""
+            INSERT INTO transactions (user_id, transaction_type, amount, timestamp)
+            VALUES (%s, 'recharge', %s, NOW())
+        """, (user_id, input_amt))
+
+        # 到账通知，由后台任务发送
+        if notify_template:
+            cur.execute(
+                "INSERT INTO notification_outbox (chat_id, text) VALUES (%s, %s)",
+                (user_id, notify_template.format(amount=input_amt.quantize(CENT), order_id=order_id))
+            )
+        _notify_invalidation(cur, [user_id])
+    user_cache.invalidate(user_id)
+    return True
+
+# 过期订单清理
+def expire_old_orders():
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE recharge_orders
+            SET status = 'expired'
+            WHERE status = 'pending' AND expires_at < NOW()
+        """)
+
+# 领取一批待发送的通知；已领取但超时未完成的通知可被重新领取
+def claim_outbox_batch(limit, claim_timeout=300, max_attempts=5):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE notification_outbox SET claimed_at = NOW(), attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM notification_outbox
+                WHERE delivered_at IS NULL AND attempts < %(max_attempts)s
+                  AND (claimed_at IS NULL OR claimed_at < NOW() - %(claim_timeout)s * INTERVAL '1 second')
+                ORDER BY id LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, text
+        """, {"limit": limit, "claim_timeout": claim_timeout, "max_attempts": max_attempts})
+        return sorted(cur.fetchall())
+
+# 重试次数用尽（且最后一次领取已结束）的通知标记为失败，不再领取；返回 [(id, chat_id)]
+def fail_exhausted_outbox(claim_timeout=300, max_attempts=5):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE notification_outbox SET delivered_at = NOW(), failed_at = NOW()
+            WHERE delivered_at IS NULL AND attempts >= %(max_attempts)s
+              AND (claimed_at IS NULL OR claimed_at < NOW() - %(claim_timeout)s * INTERVAL '1 second')
+            RETURNING id, chat_id
+        """, {"claim_timeout": claim_timeout, "max_attempts": max_attempts})
+        return cur.fetchall()
+
+# 标记通知已处理（已送达或无法送达）
+def mark_outbox_delivered(ids):
+    if not ids:
+        return
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE notification_outbox SET delivered_at = NOW() WHERE id = ANY(%s)", (list(ids),))
+
+# 释放领取，下一轮重试
+def release_outbox(ids):
+    if not ids:
+        return
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE notification_outbox SET claimed_at = NULL WHERE id = ANY(%s)", (list(ids),))
@@ -0,0 +1,44 @@
+import os
+from datetime import datetime
+from io import BytesIO
+from telegram import Update
+from telegram.ext import ContextTypes
+from profiler import profile_for, PROFILE_MAX_SECONDS
+
+# 管理员用户ID（逗号分隔）
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+# 是否开放 /cpuprofile 命令
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+
+DEFAULT_PROFILE_SECONDS = 10
+
+
+# ✅ /cpuprofile [秒数]：对当前进程采样，返回折叠栈文件（仅管理员）
+async def cpuprofile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else DEFAULT_PROFILE_SECONDS
+        if seconds <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(f"用法：/cpuprofile [1-{PROFILE_MAX_SECONDS} 秒]")
+        return
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+
+    await update.message.reply_text(f"⏱️ 开始采样 {seconds} 秒（工作进程 PID {os.getpid()}）……")
+    result = await profile_for(seconds)
+    if result is None:
+        await update.message.reply_text("⚠️ 已有采样正在进行，请稍后再试。")
+        return
+    if not result:
+        await update.message.reply_text("⚠️ 没有采集到任何调用栈。")
+        return
+
+    filename = f"profile-{os.getpid()}-{datetime.now():%Y%m%d%H%M%S}.collapsed"
+    await update.message.reply_document(
+        document=BytesIO(result.encode()),
+        filename=filename,
+        caption="折叠栈格式，可用 flamegraph.pl 或 speedscope 打开",
+    )
@@ -0,0 +1,11 @@
+import math
+
+
+# 解析用户输入的金额：返回有限的 float，无法解析时返回 None（正负由调用方校验）。
+# float() 接受 nan / inf，这里一并排除
+def parse_amount(text):
+    try:
+        amount = float(text)
+    except (TypeError, ValueError):
+        return None
+    return amount if math.isfinite(amount) else None
@@ -0,0 +1,66 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+import metrics
+
+# callback_data → 处理函数
+CALLBACKS = {}
+# 带参数的 callback_data（<前缀>:<参数>...）按前缀查找
+CALLBACK_PREFIXES = {}
+# context.user_data["action"] → 文本输入处理函数
+ACTIONS = {}
+
+# 尚未开放的功能按钮
+COMING_SOON = ("withdraw", "redpacket", "escrow", "contact")
+
+
+def _register(table, keys, func):
+    for key in keys:
+        if key in table:
+            raise ValueError(f"重复注册的路由: {key}")
+        table[key] = func
+
+
+# 注册按钮回调：@callback("profile") 或 @callback(prefix="history")
+def callback(*names, prefix=None):
+    def decorator(func):
+        _register(CALLBACKS, names, func)
+        if prefix is not None:
+            _register(CALLBACK_PREFIXES, [prefix], func)
+        return func
+    return decorator
+
+
+# 注册文本输入处理：@action("usdt_recharge")
+def action(*names):
+    def decorator(func):
+        _register(ACTIONS, names, func)
+        return func
+    return decorator
+
+
+# ✅ 统一按钮回调入口（字典查找，不逐个匹配正则）
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = update.callback_query.data or ""
+    handler = CALLBACKS.get(data)
+    if handler is None and ":" in data:
+        handler = CALLBACK_PREFIXES.get(data.split(":", 1)[0])
+    if handler is None:
+        handler = coming_soon
+    async with metrics.track(f"handler.{handler.__name__}"):
+        await handler(update, context)
+
+
+# ✅ 统一文本输入入口（转账/兑换/充值）
+async def route_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = ACTIONS.get(context.user_data.get("action"))
+    if handler is None:
+        await update.message.reply_text("⚠️ 当前无可处理的操作，请从菜单开始。")
+        return
+    async with metrics.track(f"handler.{handler.__name__}"):
+        await handler(update, context)
+
+
+# 未开放或已失效的按钮
+@callback(*COMING_SOON)
+async def coming_soon(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer("🚧 该功能暂未开放，敬请期待", show_alert=True)
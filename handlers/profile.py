@@ -1,33 +1,30 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-import psycopg2
-import os
-from dotenv import load_dotenv
+from datetime import datetime
+from db import run_db, fetch_user_info, get_history_page
 from handlers.start import start
-
-# 加载环境变量
-load_dotenv()
-
-# 连接数据库
-def get_connection():
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
-
-# 获取用户信息
-def get_user_info(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT username, usdt_balance, cny_balance FROM users WHERE user_id = %s", (user_id,))
-    user_info = cur.fetchone()
-    cur.close()
-    conn.close()
-    return user_info
-
+from handlers.views import show, PROFILE_MENU
+from handlers.dispatch import callback
+
+# 历史记录类型 → 标题
+RECORD_TITLES = {
+    "recharge": "充值记录",
+    "withdraw": "提现记录",
+    "transfer": "转账记录",
+    "redpacket": "红包记录",
+    "escrow": "担保交易记录",
+}
+HISTORY_PAGE_SIZE = 10
+# 游标时间编码（callback_data 最长 64 字节）
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+@callback("profile")
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.callback_query.from_user.id
     username = update.callback_query.from_user.username
     
     # 获取用户余额信息
-    user_info = get_user_info(user_id)
+    user_info = await fetch_user_info(user_id)
     if user_info:
         user_name = user_info[0] if user_info[0] else username
         usdt_balance = round(user_info[1], 2)  # 保留两位小数
@@ -44,145 +41,64 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 💵USDT余额：{usdt_balance:.2f}
 💴CNY余额：{cny_balance:.2f}
 """
-    # 创建个人中心菜单按钮
-    keyboard = [
-        [InlineKeyboardButton("👀查看充值记录", callback_data="recharge_records")],
-        [InlineKeyboardButton("👀查看提现记录", callback_data="withdraw_records")],
-        [InlineKeyboardButton("👀查看转账记录", callback_data="transfer_records")],
-        [InlineKeyboardButton("👀查看红包记录", callback_data="redpacket_records")],
-        [InlineKeyboardButton("👀查看担保交易", callback_data="escrow_records")],
-        [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")]
-    ]
-    
-    # 创建菜单
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     # 发送个人中心消息并附上菜单
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(profile_message, reply_markup=reply_markup)
-
-# 查询用户的充值记录（近10条）
-async def recharge_records(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.callback_query.from_user.id
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT amount, timestamp FROM transactions 
-        WHERE user_id = %s AND transaction_type = 'recharge'
-        ORDER BY timestamp DESC LIMIT 10
-    """, (user_id,))
-    records = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    if records:
-        records_message = "你的近10条充值记录：\n"
-        for record in records:
-            records_message += f"金额: {record[0]} CNY, 时间: {record[1]}\n"
-    else:
-        records_message = "没有充值记录。"
-    
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(records_message)
-
-# 查询用户的提现记录（近10条）
-async def withdraw_records(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.callback_query.from_user.id
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT amount, timestamp FROM transactions 
-        WHERE user_id = %s AND transaction_type = 'withdraw'
-        ORDER BY timestamp DESC LIMIT 10
-    """, (user_id,))
-    records = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    if records:
-        records_message = "你的近10条提现记录：\n"
-        for record in records:
-            records_message += f"金额: {record[0]} CNY, 时间: {record[1]}\n"
-    else:
-        records_message = "没有提现记录。"
-    
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(records_message)
-
-# 查询用户的转账记录（近10条）
-async def transfer_records(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show(update, profile_message, PROFILE_MENU)
+
+# 查询用户的历史记录（每页10条，按 (时间, ID) 游标翻页）
+@callback(*[f"{kind}_records" for kind in RECORD_TITLES])
+async def records(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    kind = update.callback_query.data[:-len("_records")]
+    await show_records(update, kind)
+
+# 历史记录翻页：history:<类型>:<older|newer>:<时间>:<ID>
+@callback(prefix="history")
+async def records_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.callback_query.data.split(":")
+    kind = parts[1] if len(parts) > 1 else None
+    try:
+        _, kind, direction, ts, record_id = parts
+        cursor = (datetime.strptime(ts, CURSOR_TIME_FORMAT), int(record_id))
+    except ValueError:
+        # 格式错误或过时的按钮：回到第一页
+        await show_records(update, kind)
+        return
+    await show_records(update, kind, cursor, direction)
+
+async def show_records(update: Update, kind, cursor=None, direction="older"):
     user_id = update.callback_query.from_user.id
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT amount, timestamp FROM transactions 
-        WHERE user_id = %s AND transaction_type = 'transfer'
-        ORDER BY timestamp DESC LIMIT 10
-    """, (user_id,))
-    records = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    if records:
-        records_message = "你的近10条转账记录：\n"
-        for record in records:
-            records_message += f"金额: {record[0]} CNY, 时间: {record[1]}\n"
+    if kind not in RECORD_TITLES:
+        await update.callback_query.answer()
+        return
+    rows, has_older, has_newer = await run_db(
+        get_history_page, user_id, kind, cursor, direction, HISTORY_PAGE_SIZE
+    )
+    title = RECORD_TITLES[kind]
+
+    if rows:
+        records_message = f"你的{title}：\n"
+        for record in rows:
+            records_message += f"金额: {record[1]:.2f} CNY, 时间: {record[2]}\n"
     else:
-        records_message = "没有转账记录。"
-    
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(records_message)
+        records_message = f"没有{title}。"
 
-# 查询用户的红包记录（近10条）
-async def redpacket_records(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.callback_query.from_user.id
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT amount, timestamp FROM red_packets 
-        WHERE user_id = %s
-        ORDER BY timestamp DESC LIMIT 10
-    """, (user_id,))
-    records = cur.fetchall()
-    cur.close()
-    conn.close()
+    # 翻页按钮携带当前页首/尾记录作为游标
+    nav = []
+    if rows and has_newer:
+        nav.append(InlineKeyboardButton("⬆️较新", callback_data=history_callback(kind, "newer", rows[0])))
+    if rows and has_older:
+        nav.append(InlineKeyboardButton("⬇️较早", callback_data=history_callback(kind, "older", rows[-1])))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("⬅️返回上一级", callback_data="profile")])
 
-    if records:
-        records_message = "你的近10条红包记录：\n"
-        for record in records:
-            records_message += f"金额: {record[0]} CNY, 时间: {record[1]}\n"
-    else:
-        records_message = "没有红包记录。"
-    
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(records_message)
-
-# 查询用户的担保交易记录（近10条）
-async def escrow_records(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.callback_query.from_user.id
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT amount, timestamp FROM transactions 
-        WHERE user_id = %s AND transaction_type = 'escrow'
-        ORDER BY timestamp DESC LIMIT 10
-    """, (user_id,))
-    records = cur.fetchall()
-    cur.close()
-    conn.close()
+    await show(update, records_message, InlineKeyboardMarkup(keyboard))
 
-    if records:
-        records_message = "你的近10条担保交易记录：\n"
-        for record in records:
-            records_message += f"金额: {record[0]} CNY, 时间: {record[1]}\n"
-    else:
-        records_message = "没有担保交易记录。"
-    
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(records_message)
+def history_callback(kind, direction, record):
+    return f"history:{kind}:{direction}:{record[2].strftime(CURSOR_TIME_FORMAT)}:{record[0]}"
 
 # 返回到主菜单
+@callback("back_to_main")
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
-    print("返回到主菜单")
     await start(update, context)
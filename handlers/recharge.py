@@ -1,139 +1,100 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
+from functools import lru_cache
+from io import BytesIO
 from uuid import uuid4
 import os
-import random
-import psycopg2
+import qrcode
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-import requests
+import httpx
+from db import run_db, fetch_user_info, create_recharge_order, get_pending_orders, complete_recharge, filter_unprocessed_txids
+from trongrid import TronGridPoller, MICRO_UNITS, to_micro
+from handlers.views import show, RECHARGE_MENU
+from handlers.dispatch import callback, action
+from handlers.common import parse_amount
 
 load_dotenv()
 
 RECHARGE_ADDRESS = os.getenv("USDT_RECHARGE_ADDRESS")
-TRON_API_KEY = os.getenv("TRONGRID_API_KEY")
-
-# 数据库连接
-def get_connection():
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
-
-# 获取用户余额信息
-def get_user_info(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT username, usdt_balance, cny_balance FROM users WHERE user_id = %s", (user_id,))
-    user_info = cur.fetchone()
-    cur.close()
-    conn.close()
-    return user_info
-
-# 插入充值订单
-def create_recharge_order(order_id, user_id, amount_input, amount_real):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO recharge_orders (order_id, user_id, amount_input, amount_real, address, created_at, expires_at, status)
-        VALUES (%s, %s, %s, %s, %s, NOW(), NOW() + INTERVAL '30 minutes', 'pending')
-    """, (order_id, user_id, amount_input, amount_real, RECHARGE_ADDRESS))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-# 成功到账处理
-def complete_recharge(order_id):
-    conn = get_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT user_id, amount_input, amount_real FROM recharge_orders WHERE order_id = %s", (order_id,))
-    row = cur.fetchone()
-    if not row:
-        cur.close()
-        conn.close()
-        return False
-
-    user_id, input_amt, real_amt = row
-
-    # 增加余额
-    cur.execute("UPDATE users SET usdt_balance = usdt_balance + %s WHERE user_id = %s", (input_amt, user_id))
-
-    # 写入交易记录
-    cur.execute("""
-        INSERT INTO transactions (user_id, transaction_type, amount, timestamp)
-        VALUES (%s, 'recharge', %s, NOW())
-    """, (user_id, input_amt))
-
-    # 更新订单状态
-    cur.execute("UPDATE recharge_orders SET status = 'success' WHERE order_id = %s", (order_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return True
-
-# 过期订单清理
-def expire_old_orders():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE recharge_orders
-        SET status = 'expired'
-        WHERE status = 'pending' AND expires_at < NOW()
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
+# 单笔充值金额上限（USDT），远低于 amount_real NUMERIC(20, 6) 的范围
+MAX_RECHARGE_AMOUNT = float(os.getenv("MAX_RECHARGE_AMOUNT", "1000000"))
+
+# 到账通知（写入通知队列，由后台任务发送）
+RECHARGE_NOTICE = "✅ 充值到账：{amount} USDT\n🧾订单编号：{order_id}"
+
+# 收款地址二维码的 Telegram file_id（首次上传后复用，按地址缓存）
+qr_file_ids = {}
+
+# TronGrid 增量轮询（长连接，进程内复用）
+poller = TronGridPoller(RECHARGE_ADDRESS)
+
+# 按整数微 USDT 金额索引待支付订单，每笔转账 O(1) 查找
+def match_transfers(orders, transfers, address=RECHARGE_ADDRESS):
+    index = {}
+    for order in orders:
+        index.setdefault(to_micro(order[2]), []).append(order)
+
+    address = address.lower()
+    matches = []
+    for transfer in transfers:
+        if transfer.symbol != "USDT" or transfer.to_address != address:
+            continue
+        candidates = index.get(transfer.amount)
+        if not candidates:
+            continue
+        # 先按金额定位，再检查订单有效期
+        for i, order in enumerate(candidates):
+            created_at, expires_at = order[3], order[4]
+            if created_at <= transfer.timestamp <= expires_at:
+                matches.append((order, transfer))
+                del candidates[i]
+                break
+    return matches
 
 # TronGrid 实时监听到账
-def check_pending_orders_with_trongrid():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT order_id, user_id, amount_real, created_at, expires_at
-        FROM recharge_orders
-        WHERE status = 'pending'
-    """)
-    orders = cur.fetchall()
-
+async def check_pending_orders_with_trongrid():
+    orders = await run_db(get_pending_orders)
     if not orders:
-        cur.close()
-        conn.close()
         return
 
-    headers = {"TRON-PRO-API-KEY": TRON_API_KEY}
-    url = f"https://api.trongrid.io/v1/accounts/{RECHARGE_ADDRESS}/transactions/trc20?limit=100"
-
+    # 只需拉取最早的待支付订单创建之后的交易
+    since_ms = int(min(order[3] for order in orders).timestamp() * 1000)
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        data = response.json().get("data", [])
-    except Exception as e:
+        transfers = await poller.fetch_new_transfers(since_ms)
+    except (httpx.HTTPError, ValueError) as e:
         print("TronGrid 请求失败：", e)
         return
 
-    for order_id, user_id, amount_real, created_at, expires_at in orders:
-        for tx in data:
-            try:
-                token_info = tx.get("token_info", {})
-                if token_info.get("symbol") != "USDT":
-                    continue
-                value = int(tx["value"]) / 10**6
-                to_addr = tx["to"]
-                timestamp = datetime.fromtimestamp(tx["block_timestamp"] / 1000)
+    if not transfers:
+        return
 
-                if to_addr.lower() != RECHARGE_ADDRESS.lower():
-                    continue
+    # 先跳过已入账的交易（其他进程或重启前已处理），再做匹配
+    try:
+        unprocessed = await run_db(filter_unprocessed_txids, [t.txid for t in transfers])
+    except Exception as e:
+        print("⚠️ 查询已入账交易失败:", e)
+        return
+    candidates = [t for t in transfers if t.txid in unprocessed]
 
-                if abs(value - float(amount_real)) < 0.001 and created_at <= timestamp <= expires_at:
-                    print(f"✅ 识别到账 - 订单: {order_id}, 金额: {value}, 时间: {timestamp}")
-                    complete_recharge(order_id)
-            except Exception as e:
-                print("⚠️ 解析交易失败:", e)
+    processed = transfers
+    for (order_id, user_id, amount_real, created_at, expires_at), transfer in match_transfers(orders, candidates):
+        try:
+            if await run_db(complete_recharge, order_id, transfer.txid, RECHARGE_NOTICE):
+                print(f"✅ 识别到账 - 订单: {order_id}, 金额: {transfer.amount / MICRO_UNITS}, 时间: {transfer.timestamp}")
+        except Exception as e:
+            # 入账失败时不推进水位线，下轮重新拉取该交易
+            print("⚠️ 处理到账失败:", e)
+            processed = [t for t in transfers if t.block_timestamp < transfer.block_timestamp]
+            break
 
-    cur.close()
-    conn.close()
+    poller.mark_processed(processed)
 
 # 用户点击“📥充值”
+@callback("recharge")
 async def recharge_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.callback_query.from_user.id
-    user_info = get_user_info(user_id)
+    user_info = await fetch_user_info(user_id)
 
     if user_info:
         user_name = user_info[0]
@@ -153,22 +114,18 @@ async def recharge_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 请选择充值方式：
     """
 
-    keyboard = [
-        [InlineKeyboardButton("💵USDT充值", callback_data="recharge_usdt")],
-        [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+    await show(update, text, RECHARGE_MENU)
 
 # 点击“💵USDT充值” → 提示输入金额
+@callback("recharge_usdt")
 async def recharge_prompt_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text("请输入你要充值的 💵USDT 金额：")
+    await show(update, "请输入你要充值的 💵USDT 金额：")
     context.user_data["action"] = "usdt_recharge"
 
 # 处理用户输入的金额
+@action("usdt_recharge")
 async def handle_recharge_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     user_input = update.message.text
@@ -176,23 +133,24 @@ async def handle_recharge_amount(update: Update, context: ContextTypes.DEFAULT_T
     if context.user_data.get("action") != "usdt_recharge":
         return
 
-    try:
-        base_amount = float(user_input)
-        if base_amount <= 0:
-            await update.message.reply_text("🚫 请输入有效金额。")
-            return
-    except ValueError:
+    base_amount = parse_amount(user_input)
+    if base_amount is None:
         await update.message.reply_text("🚫 金额无效，请输入数字。")
         return
+    if base_amount <= 0:
+        await update.message.reply_text("🚫 请输入有效金额。")
+        return
+    if base_amount > MAX_RECHARGE_AMOUNT:
+        await update.message.reply_text(f"🚫 单笔充值金额不能超过 {MAX_RECHARGE_AMOUNT:g} USDT。")
+        return
 
-    # 生成订单
-    suffix = round(random.uniform(0.01, 0.99), 2)
-    real_amount = round(base_amount + suffix, 2)
+    # 生成订单（实付金额在待支付订单中唯一）
     order_id = str(uuid4())
+    real_amount = await run_db(create_recharge_order, order_id, user_id, base_amount, RECHARGE_ADDRESS)
+    if real_amount is None:
+        await update.message.reply_text("⚠️ 该金额的待支付订单过多，请稍后再试或更换充值金额。")
+        return
 
-    create_recharge_order(order_id, user_id, base_amount, real_amount)
-
-    qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size=200x200&data={RECHARGE_ADDRESS}"
     msg = f"""
 请向以下地址转账：
 
@@ -207,10 +165,28 @@ async def handle_recharge_amount(update: Update, context: ContextTypes.DEFAULT_T
 到账后将自动识别并充值成功。
     """
 
-    await update.message.reply_photo(
-        photo=qr_url,
-        caption=msg,
-        parse_mode="Markdown"
-    )
+    await send_address_qr(update.message, RECHARGE_ADDRESS, msg)
 
     context.user_data.pop("action", None)
+
+# 本地生成收款地址二维码 PNG（地址固定，每个地址只生成一次）
+@lru_cache(maxsize=16)
+def address_qr_png(address):
+    buffer = BytesIO()
+    qrcode.make(address, box_size=8, border=2).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+# 发送收款二维码：优先使用已缓存的 file_id，否则上传本地图片并记录 file_id
+async def send_address_qr(message, address, caption):
+    file_id = qr_file_ids.get(address)
+    if file_id:
+        try:
+            await message.reply_photo(photo=file_id, caption=caption, parse_mode="Markdown")
+            return
+        except BadRequest as e:
+            # file_id 失效（如更换了机器人），重新上传
+            print("⚠️ 二维码 file_id 失效，重新上传:", e)
+            qr_file_ids.pop(address, None)
+
+    sent = await message.reply_photo(photo=address_qr_png(address), caption=caption, parse_mode="Markdown")
+    qr_file_ids[address] = sent.photo[-1].file_id
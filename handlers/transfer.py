@@ -1,33 +1,15 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from dotenv import load_dotenv
-import psycopg2
-import os
-
-load_dotenv()
-
-def get_connection():
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
-
-def get_user_info(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT username, usdt_balance, cny_balance FROM users WHERE user_id = %s", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row
-
-def get_user_id_by_username(username):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users WHERE username = %s", (username,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row[0] if row else None
+from db import run_db, fetch_user_info, resolve_username, transfer_balance, ACCOUNT_NOT_FOUND
+from handlers.views import show, TRANSFER_MENU
+from handlers.dispatch import callback, action
+from handlers.common import parse_amount
+
+# 转账流程保存在 user_data 中的状态
+TRANSFER_STATE_KEYS = ("to_user_id", "to_username", "transfer_amount", "action")
 
 # ✅ 转账菜单
+@callback("transfer")
 async def transfer_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
         await update.callback_query.answer()
@@ -37,7 +19,7 @@ async def transfer_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = user.id
     username = user.username
-    user_info = get_user_info(user_id)
+    user_info = await fetch_user_info(user_id)
     usdt_balance = round(user_info[1], 2) if user_info else 0
     cny_balance = round(user_info[2], 2) if user_info else 0
 
@@ -49,76 +31,44 @@ async def transfer_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 请选择转账类型：
     """
-    keyboard = [
-        [InlineKeyboardButton("💵USDT转账", callback_data="transfer_usdt")],
-        [InlineKeyboardButton("💴CNY转账", callback_data="transfer_cny")],
-        [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")]
-    ]
-
-    if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-    else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    await show(update, text, TRANSFER_MENU)
 
 # ✅ 转账类型选择
+@callback("transfer_usdt")
 async def transfer_usdt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["action"] = "transfer_usdt"
-    user_info = get_user_info(update.callback_query.from_user.id)
-    context.user_data["usdt_balance"] = float(user_info[1]) if user_info else 0
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text("请输入要转账的 💵USDT 金额：")
+    await show(update, "请输入要转账的 💵USDT 金额：")
 
+@callback("transfer_cny")
 async def transfer_cny(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["action"] = "transfer_cny"
-    user_info = get_user_info(update.callback_query.from_user.id)
-    context.user_data["cny_balance"] = float(user_info[2]) if user_info else 0
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text("请输入要转账的 💴CNY 金额：")
+    await show(update, "请输入要转账的 💴CNY 金额：")
 
 # ✅ 处理金额输入
 async def handle_transfer_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        amount = float(update.message.text)
-        if amount <= 0:
-            await update.message.reply_text("⚠️ 金额必须大于 0，请重新输入。")
-            return
-    except ValueError:
+    amount = parse_amount(update.message.text)
+    if amount is None:
         await update.message.reply_text("⚠️ 请输入有效的数字金额。")
         return
+    if amount <= 0:
+        await update.message.reply_text("⚠️ 金额必须大于 0，请重新输入。")
+        return
 
     context.user_data["transfer_amount"] = amount
     action = context.user_data.get("action")
 
-    insufficient = False
-    if action == "transfer_usdt":
-        if amount > context.user_data.get("usdt_balance", 0):
-            insufficient = True
-    elif action == "transfer_cny":
-        if amount > context.user_data.get("cny_balance", 0):
-            insufficient = True
+    # 提前提示余额不足；最终以确认转账时的条件扣款为准
+    user_info = await fetch_user_info(update.message.from_user.id)
+    balance = 0
+    if user_info:
+        balance = user_info[1] if action == "transfer_usdt" else user_info[2]
 
-    if insufficient:
+    if amount > balance:
         await update.message.reply_text("🚨操作失败，余额不足！")
         # ✅ 显示转账菜单
-        user_info = get_user_info(update.message.from_user.id)
-        usdt_balance = round(user_info[1], 2)
-        cny_balance = round(user_info[2], 2)
-        username = update.message.from_user.username
-
-        text = f"""
-🪪用户名：@{username}
-🪪用户ID：{update.message.from_user.id}
-💵USDT余额：{usdt_balance:.2f}
-💴CNY余额：{cny_balance:.2f}
-
-请选择转账类型：
-        """
-        keyboard = [
-            [InlineKeyboardButton("💵USDT转账", callback_data="transfer_usdt")],
-            [InlineKeyboardButton("💴CNY转账", callback_data="transfer_cny")],
-            [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")]
-        ]
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        await transfer_menu(update, context)
         return
 
     await update.message.reply_text("请输入你要转账的目标用户名（格式：@用户名）：")
@@ -132,7 +82,7 @@ async def handle_transfer_username(update: Update, context: ContextTypes.DEFAULT
         return
 
     to_username = text[1:]
-    to_user_id = get_user_id_by_username(to_username)
+    to_user_id = await resolve_username(to_username)
     from_user_id = update.message.from_user.id
 
     if not to_user_id:
@@ -145,7 +95,7 @@ async def handle_transfer_username(update: Update, context: ContextTypes.DEFAULT
     context.user_data["to_user_id"] = to_user_id
     context.user_data["to_username"] = to_username
 
-    from_info = get_user_info(from_user_id)
+    from_info = await fetch_user_info(from_user_id)
     usdt_balance = round(from_info[1], 2)
     cny_balance = round(from_info[2], 2)
     amount = context.user_data["transfer_amount"]
@@ -164,10 +114,19 @@ async def handle_transfer_username(update: Update, context: ContextTypes.DEFAULT
         [InlineKeyboardButton("✅确认转账", callback_data="confirm_transfer")],
         [InlineKeyboardButton("⬅️返回上一级", callback_data="transfer_menu")]
     ]
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    await show(update, text, InlineKeyboardMarkup(keyboard))
     context.user_data["awaiting_username"] = False
 
+# ✅ 转账文本输入：先输入金额，再输入目标用户名
+@action("transfer_usdt", "transfer_cny")
+async def handle_transfer_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get("awaiting_username"):
+        await handle_transfer_username(update, context)
+    else:
+        await handle_transfer_amount(update, context)
+
 # ✅ 确认转账
+@callback("confirm_transfer")
 async def confirm_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     from_user = update.callback_query.from_user
@@ -177,36 +136,35 @@ async def confirm_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = context.user_data.get("action")
 
     if not all([to_user_id, amount, action]):
-        await update.callback_query.edit_message_text("❌ 操作失败，数据不完整。")
+        await show(update, "❌ 操作失败，数据不完整。")
         return
 
-    conn = get_connection()
-    cur = conn.cursor()
-
-    if action == "transfer_usdt":
-        cur.execute("UPDATE users SET usdt_balance = usdt_balance - %s WHERE user_id = %s", (amount, from_user_id))
-        cur.execute("UPDATE users SET usdt_balance = usdt_balance + %s WHERE user_id = %s", (amount, to_user_id))
-    else:
-        cur.execute("UPDATE users SET cny_balance = cny_balance - %s WHERE user_id = %s", (amount, from_user_id))
-        cur.execute("UPDATE users SET cny_balance = cny_balance + %s WHERE user_id = %s", (amount, to_user_id))
+    currency = "usdt" if action == "transfer_usdt" else "cny"
+    notify_text = f"📥 你收到来自 @{from_user.username} 的转账：{amount} {'USDT' if action == 'transfer_usdt' else 'CNY'}"
+    # 条件扣款 + 入账 + 交易记录 + 到账通知在同一事务内完成，余额不足时返回 None，账户不存在时返回 ACCOUNT_NOT_FOUND
+    result = await run_db(transfer_balance, from_user_id, to_user_id, currency, amount, notify_text)
+    if result == ACCOUNT_NOT_FOUND:
+        clear_transfer_state(context.user_data)
+        await show(update, "❌ 收款账户不存在，转账已取消。")
+        await transfer_menu(update, context)
+        return
+    if result is None:
+        await show(update, "🚨操作失败，余额不足！")
+        await transfer_menu(update, context)
+        return
 
-    cur.execute("INSERT INTO transactions (user_id, transaction_type, amount, timestamp) VALUES (%s, 'transfer', %s, NOW())", (from_user_id, amount))
-    conn.commit()
-    cur.close()
-    conn.close()
+    # 转账完成后清理流程状态，防止重复点击确认再次转账
+    clear_transfer_state(context.user_data)
 
-    await update.callback_query.edit_message_text("✅ 转账成功，已返回转账菜单。")
+    await show(update, "✅ 转账成功，已返回转账菜单。")
     await transfer_menu(update, context)
 
-    try:
-        await context.bot.send_message(
-            chat_id=to_user_id,
-            text=f"📥 你收到来自 @{from_user.username} 的转账：{amount} {'USDT' if action == 'transfer_usdt' else 'CNY'}"
-        )
-    except:
-        print(f"无法发送通知给用户 {to_user_id}")
+def clear_transfer_state(user_data):
+    for key in TRANSFER_STATE_KEYS:
+        user_data.pop(key, None)
 
 # ✅ 返回转账菜单按钮
+@callback("transfer_menu")
 async def back_to_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     await transfer_menu(update, context)
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+# 记住最近多少条消息的渲染结果
+VIEW_CACHE_SIZE = int(os.getenv("VIEW_CACHE_SIZE", "10000"))
+
+# ✅ 固定菜单按钮（启动时构建一次，所有请求复用）
+MAIN_MENU = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("👤个人中心", callback_data="profile"),
+        InlineKeyboardButton("🔄兑换", callback_data="exchange"),
+    ],
+    [
+        InlineKeyboardButton("📥充值", callback_data="recharge"),
+        InlineKeyboardButton("📤提现", callback_data="withdraw"),
+    ],
+    [
+        InlineKeyboardButton("💳转账", callback_data="transfer"),
+        InlineKeyboardButton("🧧红包", callback_data="redpacket"),
+    ],
+    [
+        InlineKeyboardButton("⚖️担保交易", callback_data="escrow"),
+        InlineKeyboardButton("🤵‍♂️联系客服", callback_data="contact"),
+    ],
+])
+
+PROFILE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👀查看充值记录", callback_data="recharge_records")],
+    [InlineKeyboardButton("👀查看提现记录", callback_data="withdraw_records")],
+    [InlineKeyboardButton("👀查看转账记录", callback_data="transfer_records")],
+    [InlineKeyboardButton("👀查看红包记录", callback_data="redpacket_records")],
+    [InlineKeyboardButton("👀查看担保交易", callback_data="escrow_records")],
+    [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")],
+])
+
+EXCHANGE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💵USDT → 💴CNY", callback_data="usdt_to_cny")],
+    [InlineKeyboardButton("💴CNY → 💵USDT", callback_data="cny_to_usdt")],
+    [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")],
+])
+
+TRANSFER_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💵USDT转账", callback_data="transfer_usdt")],
+    [InlineKeyboardButton("💴CNY转账", callback_data="transfer_cny")],
+    [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")],
+])
+
+RECHARGE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💵USDT充值", callback_data="recharge_usdt")],
+    [InlineKeyboardButton("⬅️返回上一级", callback_data="back_to_main")],
+])
+
+
+def _markup_key(markup):
+    if markup is None:
+        return ""
+    return json.dumps(markup.to_dict(), sort_keys=True, ensure_ascii=False)
+
+# 固定菜单的序列化结果只算一次
+_STATIC_KEYS = {id(m): _markup_key(m) for m in (MAIN_MENU, PROFILE_MENU, EXCHANGE_MENU, TRANSFER_MENU, RECHARGE_MENU)}
+
+# (chat_id, message_id) → 当前显示内容的摘要
+_rendered = OrderedDict()
+
+
+def view_digest(text, reply_markup=None):
+    markup_key = _STATIC_KEYS.get(id(reply_markup))
+    if markup_key is None:
+        markup_key = _markup_key(reply_markup)
+    return hashlib.blake2b(f"{text}\0{markup_key}".encode(), digest_size=16).digest()
+
+
+def _remember(message, digest):
+    key = (message.chat_id, message.message_id)
+    _rendered[key] = digest
+    _rendered.move_to_end(key)
+    while len(_rendered) > VIEW_CACHE_SIZE:
+        _rendered.popitem(last=False)
+
+
+# 显示界面：按钮回调时编辑原消息（内容未变化则跳过），文本消息时发送新消息。
+# 机器人发出的消息都要经过这里编辑，否则记录的内容会与实际不符
+async def show(update, text, reply_markup=None):
+    digest = view_digest(text, reply_markup)
+    query = update.callback_query
+    if query is None:
+        sent = await update.message.reply_text(text, reply_markup=reply_markup)
+        _remember(sent, digest)
+        return
+
+    message = query.message
+    if message is not None and _rendered.get((message.chat_id, message.message_id)) == digest:
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # 进程重启后缓存为空，内容相同时 Telegram 会拒绝编辑
+        if "not modified" not in str(e).lower():
+            raise
+    if message is not None:
+        _remember(message, digest)
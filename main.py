@@ -1,56 +1,164 @@
+import asyncio
+import hmac
+import json
 import os
+import signal
 from dotenv import load_dotenv
+from tornado import httpserver, web
+from telegram import Update
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, filters
 )
 
 # 导入功能模块
+from db import run_db, init_pool, close_pool, expire_old_orders, CACHE_NOTIFY
+import cache_sync
+from migrations import run_migrations
+from update_processor import UserOrderedUpdateProcessor
+from persistence import PostgresUserDataPersistence
+from ratelimit import PriorityRateLimiter
+from outbox import drain_outbox, OUTBOX_INTERVAL
+from rates import rate_engine, refresh_rate, RATE_TTL
+from handlers.dispatch import route_callback, route_text
+import metrics
+from profiler import loop_watchdog
+from handlers.admin import cpuprofile, PROFILER_ENABLED
 from handlers.start import start
-from handlers.profile import (
-    profile, recharge_records, withdraw_records,
-    transfer_records, redpacket_records, escrow_records,
-    back_to_main
-)
-from handlers.exchange import (
-    exchange, usdt_to_cny, cny_to_usdt, handle_exchange_input
-)
+# 各功能模块在导入时通过 @callback / @action 注册路由
+import handlers.profile  # noqa: F401
+import handlers.exchange  # noqa: F401
+import handlers.transfer  # noqa: F401
 from handlers.recharge import (
-    recharge_menu, recharge_prompt_amount, handle_recharge_amount,
-    check_pending_orders_with_trongrid, expire_old_orders
-)
-from handlers.transfer import (
-    transfer_menu, transfer_usdt, transfer_cny,
-    handle_transfer_amount, handle_transfer_username,
-    confirm_transfer, back_to_transfer
+    check_pending_orders_with_trongrid, poller, address_qr_png, RECHARGE_ADDRESS
 )
 
 load_dotenv()
 
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# 运行模式：polling（默认）或 webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# 同时处理的更新数上限（同一用户的更新仍按顺序处理）
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+# 会话状态写回数据库的间隔（秒）；多个进程共享同一批用户时开启 PERSISTENCE_REFRESH
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+PERSISTENCE_REFRESH = os.getenv("PERSISTENCE_REFRESH", "false").lower() == "true"
+# 分片部署（sharding.py）时由路由进程设置；后台任务只在 0 号进程运行
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+# Telegram 全局发送上限（每秒），分片时由各工作进程均分
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+
 # ✅ 异步定时任务（每分钟检查充值）
 async def periodic_check(context: ContextTypes.DEFAULT_TYPE):
-    print("⏳ 后台任务：检查充值订单状态")
-    check_pending_orders_with_trongrid()
-    expire_old_orders()
-
-# ✅ 统一文本输入处理函数（转账/兑换/充值）
-async def handle_user_input(update, context):
-    action = context.user_data.get("action")
-
-    if action in ["usdt_to_cny", "cny_to_usdt"]:
-        await handle_exchange_input(update, context)
-
-    elif action in ["transfer_usdt", "transfer_cny"]:
-        if context.user_data.get("awaiting_username"):
-            await handle_transfer_username(update, context)
-        else:
-            await handle_transfer_amount(update, context)
+    await check_pending_orders_with_trongrid()
+    await run_db(expire_old_orders)
+
+# ✅ 启动时先获取一次汇率，并生成收款地址二维码
+async def on_startup(app):
+    await rate_engine.refresh()
+    if RECHARGE_ADDRESS:
+        address_qr_png(RECHARGE_ADDRESS)
+    if metrics.METRICS_PORT:
+        await metrics.start_server(int(metrics.METRICS_PORT) + WORKER_INDEX)
+    # ✅ 事件循环阻塞检测（设置 LOOP_STALL_THRESHOLD_MS 后开启）
+    if loop_watchdog is not None:
+        loop_watchdog.start()
+    # ✅ 多进程部署时监听其他进程的缓存失效通知
+    if CACHE_NOTIFY:
+        cache_sync.start_listener()
+
+# ✅ 退出时关闭 TronGrid / 汇率接口长连接和数据库连接池
+async def on_shutdown(app):
+    await poller.close()
+    await rate_engine.close()
+    metrics.stop_server()
+    if loop_watchdog is not None:
+        loop_watchdog.stop()
+    cache_sync.stop_listener()
+    close_pool()
+
+# ✅ Webhook 模式：内置 HTTP 服务器接收 Telegram 推送，校验 secret token
+def run_webhook(app):
+    secret = os.getenv("WEBHOOK_SECRET")
+    if not secret:
+        print("❌ 错误：webhook 模式必须设置 WEBHOOK_SECRET")
+        return
+    listen = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+    port = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT", "8443"))
+    path = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+    public_url = os.getenv("WEBHOOK_URL")
+    if not public_url:
+        # 没有公网地址（本地测试、分片工作进程）：只在本地接收更新，不调用 setWebhook
+        asyncio.run(serve_local_webhook(app, listen, port, path, secret))
+        return
 
-    elif action == "usdt_recharge":
-        await handle_recharge_amount(update, context)
+    # 收到 SIGTERM/SIGINT 后停止接收新请求，处理完已接收的更新再退出
+    app.run_webhook(
+        listen=listen,
+        port=port,
+        url_path=path,
+        secret_token=secret,
+        webhook_url=f"{public_url.rstrip('/')}/{path}",
+    )
+
+# 本地接收更新的 HTTP 接口：校验 secret token 后放入 update_queue
+class LocalUpdateHandler(web.RequestHandler):
+    def initialize(self, app, secret):
+        self.app = app
+        self.secret = secret
+
+    async def post(self):
+        token = self.request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, self.secret):
+            self.set_status(403)
+            return
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+        self.set_status(200)
+
+# 不经过 PTB 的 Updater（它在 webhook_url 为空时也会用监听地址调用 setWebhook），
+# 自行管理 Application 的生命周期
+async def serve_local_webhook(app, listen, port, path, secret):
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+
+    server = httpserver.HTTPServer(web.Application([
+        (rf"/{path}", LocalUpdateHandler, {"app": app, "secret": secret}),
+    ]))
+    server.listen(port, address=listen)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # 停止接收新请求，处理完已接收的更新再退出
+    server.stop()
+    await app.stop()
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+# ✅ 注册处理器（bench.py 复用）
+def add_handlers(app):
+    # ✅ 命令处理
+    app.add_handler(CommandHandler("start", metrics.instrumented(start)))
+    # ✅ 管理员采样命令（设置 PROFILER_ENABLED=true 后开放）
+    if PROFILER_ENABLED:
+        app.add_handler(CommandHandler("cpuprofile", metrics.instrumented(cpuprofile)))
 
-    else:
-        await update.message.reply_text("⚠️ 当前无可处理的操作，请从菜单开始。")
+    # ✅ 按钮回调与文本输入：各只注册一个处理器，按字典路由
+    app.add_handler(CallbackQueryHandler(route_callback))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, route_text))
 
 # ✅ 主函数入口
 def main():
@@ -59,41 +167,47 @@ def main():
         print("❌ 错误：BOT_TOKEN 未设置")
         return
 
-    app = ApplicationBuilder().token(bot_token).build()
-
-    # ✅ 命令处理
-    app.add_handler(CommandHandler("start", start))
-
-    # ✅ 按钮回调处理
-    app.add_handler(CallbackQueryHandler(profile, pattern="^profile$"))
-    app.add_handler(CallbackQueryHandler(recharge_records, pattern="^recharge_records$"))
-    app.add_handler(CallbackQueryHandler(withdraw_records, pattern="^withdraw_records$"))
-    app.add_handler(CallbackQueryHandler(transfer_records, pattern="^transfer_records$"))
-    app.add_handler(CallbackQueryHandler(redpacket_records, pattern="^redpacket_records$"))
-    app.add_handler(CallbackQueryHandler(escrow_records, pattern="^escrow_records$"))
-
-    app.add_handler(CallbackQueryHandler(exchange, pattern="^exchange$"))
-    app.add_handler(CallbackQueryHandler(usdt_to_cny, pattern="^usdt_to_cny$"))
-    app.add_handler(CallbackQueryHandler(cny_to_usdt, pattern="^cny_to_usdt$"))
-
-    app.add_handler(CallbackQueryHandler(recharge_menu, pattern="^recharge$"))
-    app.add_handler(CallbackQueryHandler(recharge_prompt_amount, pattern="^recharge_usdt$"))
-
-    app.add_handler(CallbackQueryHandler(transfer_menu, pattern="^transfer$"))
-    app.add_handler(CallbackQueryHandler(transfer_usdt, pattern="^transfer_usdt$"))
-    app.add_handler(CallbackQueryHandler(transfer_cny, pattern="^transfer_cny$"))
-    app.add_handler(CallbackQueryHandler(confirm_transfer, pattern="^confirm_transfer$"))
-    app.add_handler(CallbackQueryHandler(back_to_transfer, pattern="^transfer_menu$"))
-    app.add_handler(CallbackQueryHandler(back_to_main, pattern="^back_to_main$"))
-
-    # ✅ 文本消息处理
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_input))
+    # ✅ 启动时建立数据库连接池，所有处理函数复用
+    init_pool()
+    # ✅ 启动时执行数据库迁移（建表与索引）
+    run_migrations()
+    builder = ApplicationBuilder()
+    # 本地 webhook 自行接收更新，不需要 Updater
+    if BOT_MODE == "webhook" and not os.getenv("WEBHOOK_URL"):
+        builder = builder.updater(None)
+    app = (
+        builder
+        .token(bot_token)
+        .concurrent_updates(UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(PostgresUserDataPersistence(
+            PERSISTENCE_INTERVAL, PERSISTENCE_REFRESH,
+            shard=(WORKER_INDEX, WORKER_COUNT) if WORKER_COUNT > 1 else None,
+        ))
+        .rate_limiter(PriorityRateLimiter(overall_rate=TELEGRAM_GLOBAL_RATE / WORKER_COUNT))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    add_handlers(app)
+
+    # ✅ 汇率在缓存过期前刷新（每个进程各自缓存）
+    app.job_queue.run_repeating(refresh_rate, interval=max(RATE_TTL / 2, 1), first=RATE_TTL / 2)
+    # ✅ 定期输出运行指标
+    if metrics.METRICS_LOG_INTERVAL > 0:
+        app.job_queue.run_repeating(metrics.log_metrics, interval=metrics.METRICS_LOG_INTERVAL)
 
     # ✅ 后台轮询任务
-    app.job_queue.run_repeating(periodic_check, interval=60, first=10)
-
-    print("🤖 Ant 钱包机器人已启动")
-    app.run_polling()
+    if WORKER_INDEX == 0:
+        app.job_queue.run_repeating(metrics.instrumented(periodic_check, "job.periodic_check"), interval=60, first=10)
+        # ✅ 通知队列（转账、充值到账）
+        app.job_queue.run_repeating(metrics.instrumented(drain_outbox, "job.drain_outbox"), interval=OUTBOX_INTERVAL, first=5)
+
+    print(f"🤖 Ant 钱包机器人已启动（{BOT_MODE} 模式）")
+    if BOT_MODE == "webhook":
+        run_webhook(app)
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,181 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager
+
+# 定期把指标打印到日志的间隔（秒），0 表示关闭
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
+# 本地指标接口端口（分片时第 i 个工作进程使用 METRICS_PORT + i），未设置则不启动
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+# 直方图桶上限（毫秒）
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+# 当前更新的数据库统计（查询次数、耗时），由 run_db 复制到数据库线程
+_update_stats = contextvars.ContextVar("update_stats", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    # 按桶估算分位数（返回所在桶的上限，最后一个桶返回最大值）
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+# 其他模块登记的统计来源：名称 → 返回 dict 的函数（如缓存命中率）
+_stats_sources = {}
+
+
+def observe(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds * 1000)
+
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+# 登记统计来源，render() 时调用：register_stats("cache.user_cache", user_cache.stats)
+def register_stats(name, func):
+    _stats_sources[name] = func
+
+
+# 同步代码计时：with timer("trongrid.fetch"): ...（异常计入 <name>.errors）
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        incr(f"{name}.errors")
+        raise
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+# 处理一次更新/任务：记录耗时、异常次数，以及期间的数据库查询次数和耗时
+@asynccontextmanager
+async def track(name):
+    stats = {"queries": 0, "db_time": 0.0}
+    token = _update_stats.set(stats)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        incr(f"{name}.errors")
+        raise
+    finally:
+        _update_stats.reset(token)
+        observe(name, time.perf_counter() - start)
+        observe(f"{name}.db", stats["db_time"])
+        incr(f"{name}.db_queries", stats["queries"])
+
+
+# 装饰处理函数：instrumented(start) 或 instrumented(periodic_check, "job.periodic_check")
+def instrumented(func, name=None):
+    name = name or f"handler.{func.__name__}"
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with track(name):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+# 由数据库游标调用：计入当前更新的查询次数与耗时
+def record_query(seconds):
+    stats = _update_stats.get()
+    if stats is not None:
+        stats["queries"] += 1
+        stats["db_time"] += seconds
+
+
+def render():
+    with _lock:
+        histograms = {name: (h.count, h.total, h.percentile(0.5), h.percentile(0.99), h.max) for name, h in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name in sorted(histograms):
+        count, total, p50, p99, peak = histograms[name]
+        lines.append(
+            f"{name} count={count} avg={total / count if count else 0:.1f}ms "
+            f"p50<={p50:.0f}ms p99<={p99:.0f}ms max={peak:.1f}ms"
+        )
+    for name in sorted(counters):
+        lines.append(f"{name} {counters[name]}")
+    for name in sorted(_stats_sources):
+        stats = _stats_sources[name]()
+        lines.append(name + " " + " ".join(
+            f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in stats.items()
+        ))
+    return "\n".join(lines)
+
+
+# ✅ 定时任务：把指标打印到日志
+async def log_metrics(context):
+    text = render()
+    if text:
+        print("📊 运行指标\n" + text)
+
+
+# 本地指标接口：任意 HTTP 请求都返回纯文本指标
+async def _serve(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = (render() + "\n").encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+_server = None
+
+
+async def start_server(port):
+    global _server
+    _server = await asyncio.start_server(_serve, "127.0.0.1", port)
+    print(f"📊 指标接口已启动：http://127.0.0.1:{port}/")
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        _server = None
@@ -0,0 +1,153 @@
+from db import get_connection
+
+# 迁移锁 ID（pg_advisory_xact_lock），多个进程同时启动时只有一个执行迁移
+MIGRATION_LOCK_ID = 7_351_001
+
+# 版本化迁移：(版本号, 说明, SQL 列表)，已上线的迁移只能追加、不能修改
+MIGRATIONS = [
+    (1, "create core tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            usdt_balance NUMERIC(20, 6) NOT NULL DEFAULT 0 CHECK (usdt_balance >= 0),
+            cny_balance NUMERIC(20, 6) NOT NULL DEFAULT 0 CHECK (cny_balance >= 0)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            transaction_type TEXT NOT NULL,
+            amount NUMERIC(20, 6) NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS recharge_orders (
+            order_id TEXT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount_input NUMERIC(20, 6) NOT NULL,
+            amount_real NUMERIC(20, 6) NOT NULL,
+            address TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            expires_at TIMESTAMP NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS red_packets (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount NUMERIC(20, 6) NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+        # 手工建的旧表可能没有 id，历史记录游标分页需要
+        "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS id BIGSERIAL",
+        "ALTER TABLE red_packets ADD COLUMN IF NOT EXISTS id BIGSERIAL",
+    ]),
+    (2, "processed transaction ledger", [
+        """
+        CREATE TABLE IF NOT EXISTS processed_transactions (
+            txid TEXT PRIMARY KEY,
+            order_id TEXT NOT NULL,
+            processed_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+    ]),
+    (3, "indexes for hot queries", [
+        # 转账时按用户名（不区分大小写）查找
+        "CREATE INDEX IF NOT EXISTS users_username_lower_idx ON users (lower(username))",
+        # 轮询待支付订单 / 清理过期订单
+        """
+        CREATE INDEX IF NOT EXISTS recharge_orders_pending_expires_idx
+        ON recharge_orders (expires_at) WHERE status = 'pending'
+        """,
+        # 旧版随机尾数可能产生实付金额相同的待支付订单，建唯一索引前先清理：
+        # 已超时的订单标记为过期；同一金额仍有多笔时只保留最早的一笔
+        """
+        UPDATE recharge_orders SET status = 'expired'
+        WHERE status = 'pending' AND expires_at < NOW()
+        """,
+        """
+        UPDATE recharge_orders SET status = 'expired'
+        WHERE order_id IN (
+            SELECT order_id FROM (
+                SELECT order_id, row_number() OVER (
+                    PARTITION BY amount_real ORDER BY created_at, order_id
+                ) AS seq
+                FROM recharge_orders WHERE status = 'pending'
+            ) ranked
+            WHERE seq > 1
+        )
+        """,
+        # 待支付订单的实付金额唯一，订单过期或完成后槽位自动释放
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS recharge_orders_pending_amount_key
+        ON recharge_orders (amount_real) WHERE status = 'pending'
+        """,
+        # 历史记录按 (timestamp, id) 游标分页
+        """
+        CREATE INDEX IF NOT EXISTS transactions_user_type_time_idx
+        ON transactions (user_id, transaction_type, timestamp DESC, id DESC)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS red_packets_user_time_idx
+        ON red_packets (user_id, timestamp DESC, id DESC)
+        """,
+    ]),
+    (4, "persisted conversation state", [
+        """
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+    ]),
+    (5, "notification outbox", [
+        """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            claimed_at TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            delivered_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS notification_outbox_pending_idx
+        ON notification_outbox (id) WHERE delivered_at IS NULL
+        """,
+    ]),
+    (6, "failed notifications", [
+        # 重试次数用尽的通知：记录失败时间并移出待发送队列
+        "ALTER TABLE notification_outbox ADD COLUMN IF NOT EXISTS failed_at TIMESTAMP",
+    ]),
+]
+
+
+# 执行尚未应用的迁移（启动时调用，整体在一个事务内完成）
+def run_migrations():
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cur.fetchall()}
+
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            print(f"🗄️ 已执行数据库迁移 {version}: {name}")
@@ -0,0 +1,39 @@
+import asyncio
+import os
+from telegram.error import BadRequest, Forbidden, TelegramError
+from telegram.ext import ContextTypes
+from db import run_db, claim_outbox_batch, mark_outbox_delivered, release_outbox, fail_exhausted_outbox
+from ratelimit import PRIORITY_BACKGROUND
+
+# 每轮最多发送的通知数与发送间隔（秒）
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_INTERVAL = float(os.getenv("OUTBOX_INTERVAL", "2"))
+
+
+# 后台任务：批量发送通知队列（notification_outbox）中的消息
+async def drain_outbox(context: ContextTypes.DEFAULT_TYPE):
+    # 多次发送失败的通知不再重试，记录到日志
+    for outbox_id, chat_id in await run_db(fail_exhausted_outbox):
+        print(f"❌ 通知 {outbox_id} 多次发送给用户 {chat_id} 失败，已放弃")
+
+    batch = await run_db(claim_outbox_batch, OUTBOX_BATCH_SIZE)
+    if not batch:
+        return
+
+    results = await asyncio.gather(*(_send(context.bot, chat_id, text) for _, chat_id, text in batch))
+    done = [row[0] for row, ok in zip(batch, results) if ok]
+    retry = [row[0] for row, ok in zip(batch, results) if not ok]
+    await run_db(mark_outbox_delivered, done)
+    await run_db(release_outbox, retry)
+
+# 返回 True 表示已处理（送达或永久失败），False 表示稍后重试
+async def _send(bot, chat_id, text):
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=PRIORITY_BACKGROUND)
+    except (Forbidden, BadRequest) as e:
+        # 用户已屏蔽机器人或会话不存在，重试无意义
+        print(f"无法发送通知给用户 {chat_id}:", e)
+    except TelegramError as e:
+        print(f"发送通知给用户 {chat_id} 失败，稍后重试:", e)
+        return False
+    return True
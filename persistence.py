@@ -0,0 +1,160 @@
+import asyncio
+import json
+from psycopg2.extras import execute_values
+from telegram.ext import BasePersistence, PersistenceInput
+from db import get_connection, run_db
+
+# 合并写入的延迟（秒）：同一轮 update_persistence 中变化的会话一次性写入
+FLUSH_DELAY = 1
+
+
+# 会话状态（context.user_data）持久化到 PostgreSQL
+# 只写入内容变化过的用户，多个写入合并为一条批量 upsert
+class PostgresUserDataPersistence(BasePersistence):
+    def __init__(self, update_interval=60, refresh_on_update=False, shard=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        # 多进程共享同一批用户时，处理每个更新前从数据库刷新该用户的状态
+        self.refresh_on_update = refresh_on_update
+        # 分片部署时为 (进程序号, 进程总数)，启动时只加载本进程负责的用户
+        self.shard = shard
+        # 用户ID → 最近一次写入/读取的 JSON（用于脏检查）
+        self._flushed = {}
+        # 用户ID → 待写入的 JSON，None 表示待删除
+        self._dirty = {}
+        self._flush_task = None
+
+    async def get_user_data(self):
+        rows = await run_db(_load_all_user_data, self.shard)
+        user_data = {}
+        for user_id, data in rows:
+            user_data[user_id] = data
+            self._flushed[user_id] = _encode(data)
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        try:
+            encoded = _encode(data)
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ 用户 {user_id} 的会话状态无法序列化，跳过持久化:", e)
+            return
+        if self._flushed.get(user_id) == encoded:
+            self._dirty.pop(user_id, None)
+            return
+        self._dirty[user_id] = encoded
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._dirty[user_id] = None
+        self._schedule_flush()
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not self.refresh_on_update or user_id in self._dirty:
+            return
+        data = await run_db(_load_user_data, user_id)
+        if data is None:
+            return
+        encoded = _encode(data)
+        if encoded != self._flushed.get(user_id):
+            user_data.clear()
+            user_data.update(data)
+            self._flushed[user_id] = encoded
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_dirty()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(FLUSH_DELAY)
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await run_db(_write_user_data, batch)
+        except Exception as e:
+            # 写入失败时放回待写队列，下次重试（期间的新变化优先）
+            print("⚠️ 会话状态写入失败:", e)
+            for user_id, encoded in batch.items():
+                self._dirty.setdefault(user_id, encoded)
+            return
+        for user_id, encoded in batch.items():
+            if encoded is None:
+                self._flushed.pop(user_id, None)
+            else:
+                self._flushed[user_id] = encoded
+
+    # 以下数据类型未启用持久化
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+# 统一编码，便于比较内容是否变化
+def _encode(data):
+    return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+def _load_all_user_data(shard=None):
+    with get_connection() as conn, conn.cursor() as cur:
+        if shard is None:
+            cur.execute("SELECT user_id, data FROM bot_user_data")
+        else:
+            index, count = shard
+            cur.execute("SELECT user_id, data FROM bot_user_data WHERE user_id %% %s = %s", (count, index))
+        return cur.fetchall()
+
+def _load_user_data(user_id):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT data FROM bot_user_data WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def _write_user_data(batch):
+    upserts = [(user_id, encoded) for user_id, encoded in batch.items() if encoded is not None]
+    deletes = [user_id for user_id, encoded in batch.items() if encoded is None]
+    with get_connection() as conn, conn.cursor() as cur:
+        if upserts:
+            execute_values(cur, """
+                INSERT INTO bot_user_data (user_id, data, updated_at) VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+            """, upserts, template="(%s, %s::jsonb, NOW())")
+        if deletes:
+            cur.execute("DELETE FROM bot_user_data WHERE user_id = ANY(%s)", (deletes,))
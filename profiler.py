@@ -0,0 +1,102 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+import metrics
+
+# 采样间隔（秒）与单次采样最长时间
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# 事件循环阻塞超过该毫秒数时打印阻塞处的调用栈，0 表示关闭
+LOOP_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "0"))
+
+_profile_lock = threading.Lock()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+# 采样所有线程的调用栈 seconds 秒，返回折叠栈文本（flamegraph.pl / speedscope 可直接读取）。
+# 同一时间只允许一个采样，正在采样时返回 None
+def sample(seconds, interval=PROFILE_INTERVAL):
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        me = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                labels.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(labels))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    finally:
+        _profile_lock.release()
+
+
+# 在后台线程中采样，不阻塞事件循环
+async def profile_for(seconds):
+    return await asyncio.to_thread(sample, min(seconds, PROFILE_MAX_SECONDS))
+
+
+# 事件循环阻塞检测：循环内的心跳任务定时打点，后台线程发现心跳超时就打印循环线程当前的调用栈
+class LoopWatchdog:
+    def __init__(self, threshold_ms=LOOP_STALL_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        self.beat_interval = self.threshold / 4
+        self.last_beat = time.monotonic()
+        self.loop_thread = None
+        self._heartbeat = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._heartbeat = asyncio.get_running_loop().create_task(self._beat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.beat_interval
+            await asyncio.sleep(self.beat_interval)
+            now = time.monotonic()
+            # 心跳迟到的时间即事件循环的调度延迟
+            metrics.observe("loop.lag", max(now - expected, 0))
+            self.last_beat = now
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.beat_interval):
+            beat = self.last_beat
+            stalled = time.monotonic() - beat
+            # 每次阻塞只报告一次
+            if stalled < self.threshold or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "（无法获取调用栈）\n"
+            metrics.incr("loop.stalls")
+            print(f"⚠️ 事件循环已阻塞 {stalled * 1000:.0f} ms，当前调用栈：\n{stack}", end="")
+
+
+loop_watchdog = LoopWatchdog() if LOOP_STALL_THRESHOLD_MS > 0 else None
@@ -0,0 +1,142 @@
+import asyncio
+import heapq
+import itertools
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import metrics
+
+# 优先级：数字越小越先发送
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# 不受限流的接口（拉取更新与 webhook 管理）
+EXEMPT_ENDPOINTS = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo"}
+# 聊天级令牌桶数量超过该值时清理空闲桶
+MAX_CHAT_BUCKETS = 10000
+
+
+# 令牌桶：rate 为每秒令牌数，capacity 为允许的突发数量
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # 收到 429 后在此时间前不再发送
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    # 距离下一个可用令牌还需等待的秒数
+    def delay(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while (wait := self.delay()) > 0:
+                await asyncio.sleep(wait)
+            self.take()
+
+
+# 全局 + 每个聊天的令牌桶限流；全局令牌按优先级分配（交互回复优先于后台通知），
+# 遇到 429 自动按 retry_after 等待后重试
+class PriorityRateLimiter(BaseRateLimiter):
+    def __init__(self, overall_rate=30, private_chat_rate=1, group_chat_rate=20 / 60, chat_burst=3, max_retries=3):
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        # 等待全局令牌的请求：(优先级, 序号, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in EXEMPT_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+
+        for attempt in range(self.max_retries + 1):
+            if chat_bucket is not None:
+                await chat_bucket.acquire()
+            await self._acquire_overall(priority)
+            try:
+                with metrics.timer(f"telegram.{endpoint}"):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt == self.max_retries:
+                    raise
+                delay = exc.retry_after
+                if hasattr(delay, "total_seconds"):
+                    delay = delay.total_seconds()
+                print(f"⚠️ Telegram 限流（{endpoint}，chat_id={chat_id}），{delay} 秒后重试")
+                # 暂停对应的桶，其他发往同一目标的请求也一起等待
+                (chat_bucket or self.overall).pause(delay)
+                await asyncio.sleep(delay)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                self._prune_chat_buckets()
+            # 群组/频道的 chat_id 为负数，限额更严格
+            rate = self.group_chat_rate if str(chat_id).startswith("-") else self.private_chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _prune_chat_buckets(self):
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if not bucket.lock.locked() and bucket.delay() == 0 and bucket.tokens >= bucket.capacity:
+                del self._chat_buckets[chat_id]
+
+    async def _acquire_overall(self, priority):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._wakeup.set()
+        await future
+
+    # 按优先级依次发放全局令牌
+    async def _dispatch(self):
+        while True:
+            while not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            wait = self.overall.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # 等待方已取消
+                continue
+            self.overall.take()
+            future.set_result(None)
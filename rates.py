@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import time
+import httpx
+import metrics
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 汇率来源：static（固定值）、file（本地 JSON/文本文件）、http（远程接口）
+RATE_SOURCE = os.getenv("RATE_SOURCE", "static")
+RATE_URL = os.getenv("RATE_URL")
+RATE_FILE = os.getenv("RATE_FILE", "rate.json")
+# JSON 返回中汇率所在字段
+RATE_FIELD = os.getenv("RATE_FIELD", "usdt_cny")
+# 固定汇率，也是其他来源首次获取失败时的兜底值：1 USDT = 7 CNY
+DEFAULT_RATE = float(os.getenv("USDT_TO_CNY_RATE", "7"))
+# 缓存有效期（秒），过期后继续使用旧值并在后台刷新
+RATE_TTL = float(os.getenv("RATE_TTL", "60"))
+# 旧值最多使用多久（秒），超过后暂停兑换，避免按严重过时的汇率成交
+RATE_MAX_STALE = float(os.getenv("RATE_MAX_STALE", "600"))
+# 兑换菜单展示的汇率锁定时间（秒）
+QUOTE_LOCK_SECONDS = int(os.getenv("QUOTE_LOCK_SECONDS", "60"))
+
+
+# 从返回内容中解析汇率：纯数字或 {"usdt_cny": 7.1}
+def parse_rate(text, field=RATE_FIELD):
+    text = text.strip()
+    try:
+        rate = float(text)
+    except ValueError:
+        rate = float(json.loads(text)[field])
+    if rate <= 0:
+        raise ValueError(f"无效汇率: {rate}")
+    return rate
+
+
+class StaticRateSource:
+    def __init__(self, rate=DEFAULT_RATE):
+        self.rate = rate
+
+    async def fetch(self):
+        return self.rate
+
+    async def close(self):
+        pass
+
+
+# 本地文件（测试或手工维护汇率），每次刷新重新读取
+class FileRateSource:
+    def __init__(self, path=RATE_FILE, field=RATE_FIELD):
+        self.path = path
+        self.field = field
+
+    async def fetch(self):
+        with open(self.path, encoding="utf-8") as f:
+            return parse_rate(f.read(), self.field)
+
+    async def close(self):
+        pass
+
+
+# 远程汇率接口（长连接复用）
+class HttpRateSource:
+    def __init__(self, url=RATE_URL, field=RATE_FIELD):
+        self.url = url
+        self.field = field
+        self._client = None
+
+    async def fetch(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        with metrics.timer("rates.fetch"):
+            response = await self._client.get(self.url)
+            response.raise_for_status()
+        return parse_rate(response.text, self.field)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def build_source(kind=RATE_SOURCE):
+    if kind == "file":
+        return FileRateSource()
+    if kind == "http":
+        if not RATE_URL:
+            raise ValueError("RATE_SOURCE=http 时必须设置 RATE_URL")
+        return HttpRateSource()
+    return StaticRateSource()
+
+
+# 汇率缓存：读取只查内存，从不等待上游；过期后返回旧值并触发一次后台刷新
+class RateEngine:
+    def __init__(self, source, ttl=RATE_TTL, max_stale=RATE_MAX_STALE, fallback=DEFAULT_RATE):
+        self.source = source
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.fallback = fallback
+        self.rate = None
+        # 从未获取成功时按进程启动时间计算过期
+        self.updated = time.monotonic()
+        self._refreshing = None
+
+    # 当前 USDT → CNY 汇率；超过 max_stale 仍未刷新成功时返回 None
+    def current(self):
+        age = time.monotonic() - self.updated
+        if self.rate is None or age > self.ttl:
+            self._refresh_in_background()
+        if self.rate is None:
+            # 从未获取成功：启动后 max_stale 内使用兜底值，之后同样暂停兑换
+            return self.fallback if age <= self.max_stale else None
+        if age > self.max_stale:
+            return None
+        return self.rate
+
+    # 拉取最新汇率，失败时保留旧值
+    async def refresh(self):
+        try:
+            rate = await self.source.fetch()
+        except Exception as e:
+            print("⚠️ 汇率刷新失败，继续使用旧值:", e)
+            return
+        if rate != self.rate:
+            print(f"💱 汇率更新：1 USDT = {rate} CNY")
+        self.rate = rate
+        self.updated = time.monotonic()
+
+    # 同一时间只有一个刷新任务
+    def _refresh_in_background(self):
+        if self._refreshing is not None and not self._refreshing.done():
+            return
+        try:
+            self._refreshing = asyncio.get_running_loop().create_task(self.refresh())
+        except RuntimeError:  # 不在事件循环中（如离线脚本），由定时任务负责刷新
+            pass
+
+    async def close(self):
+        await self.source.close()
+
+
+rate_engine = RateEngine(build_source())
+
+
+# ✅ 定时任务：在缓存过期前刷新汇率
+async def refresh_rate(context):
+    await rate_engine.refresh()
+
+
+# 生成报价并保存到会话，兑换时在锁定期内按此报价成交。
+# 报价按展示精度取整：rate 为 1 USDT 兑 CNY（2 位小数），inverse 为 1 CNY 兑 USDT（4 位小数），
+# 用户看到的数字就是成交价
+def lock_quote(user_data, rate):
+    rate = round(rate, 2)
+    quote = {"rate": rate, "inverse": round(1 / rate, 4), "expires_at": time.time() + QUOTE_LOCK_SECONDS}
+    user_data["quote"] = quote
+    return quote
+
+
+# 取出未过期的报价（只能使用一次），已过期或不存在时返回 None
+def take_quote(user_data):
+    quote = user_data.pop("quote", None)
+    if not quote or quote["expires_at"] < time.time() or "inverse" not in quote:
+        return None
+    return quote
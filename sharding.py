@@ -0,0 +1,189 @@
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import httpx
+from dotenv import load_dotenv
+from tornado import httpserver, web
+
+load_dotenv()
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+# 工作进程数量与本地端口（第 i 个进程监听 SHARD_BASE_PORT + i）
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS") or os.cpu_count() or 1)
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "9000"))
+# 转发失败（如工作进程重启中）的重试次数，退避上限 5 秒
+FORWARD_RETRIES = 10
+# 退出时等待队列转发完毕的最长时间（秒）
+DRAIN_TIMEOUT = 20
+
+
+# 取更新的发起用户ID（没有用户的更新按聊天ID，都没有则固定分到 0 号进程）
+def shard_key(update):
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            entity = value.get(field)
+            if isinstance(entity, dict) and "id" in entity:
+                return entity["id"]
+    return 0
+
+
+# 前端路由：接收 Telegram 推送，按用户ID哈希转发到本机的 N 个工作进程，
+# 每个工作进程一个有序转发队列，保证同一用户的更新顺序
+class ShardRouter:
+    def __init__(self, workers, base_port, path, secret):
+        self.workers = workers
+        self.base_port = base_port
+        self.path = path
+        self.secret = secret
+        # 路由与工作进程之间的内部密钥
+        self.internal_secret = secrets.token_urlsafe(32)
+        self.queues = [asyncio.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.stopping = False
+
+    def dispatch(self, update, body):
+        self.queues[shard_key(update) % self.workers].put_nowait(body)
+
+    def spawn_worker(self, index):
+        env = dict(
+            os.environ,
+            BOT_MODE="webhook",
+            WEBHOOK_LISTEN="127.0.0.1",
+            WEBHOOK_PORT=str(self.base_port + index),
+            WEBHOOK_PATH=self.path,
+            WEBHOOK_SECRET=self.internal_secret,
+            WORKER_INDEX=str(index),
+            WORKER_COUNT=str(self.workers),
+        )
+        # 由路由负责 setWebhook，工作进程不占用公网端口；
+        # 没有 WEBHOOK_URL 时工作进程只在本地接收更新（main.serve_local_webhook），不调用 setWebhook
+        env.pop("WEBHOOK_URL", None)
+        env.pop("PORT", None)
+        self.processes[index] = subprocess.Popen([sys.executable, MAIN_SCRIPT], env=env)
+        print(f"🧩 工作进程 {index} 已启动（端口 {self.base_port + index}）")
+
+    # 工作进程异常退出时自动拉起
+    async def supervise(self):
+        while not self.stopping:
+            for index, process in enumerate(self.processes):
+                if process is not None and process.poll() is not None and not self.stopping:
+                    print(f"⚠️ 工作进程 {index} 已退出（code={process.returncode}），正在重启")
+                    self.spawn_worker(index)
+            await asyncio.sleep(2)
+
+    # 按顺序把队列中的更新转发给对应的工作进程
+    async def forward(self, index, client):
+        url = f"http://127.0.0.1:{self.base_port + index}/{self.path}"
+        headers = {"Content-Type": "application/json", SECRET_HEADER: self.internal_secret}
+        queue = self.queues[index]
+        while True:
+            body = await queue.get()
+            for attempt in range(FORWARD_RETRIES):
+                try:
+                    response = await client.post(url, content=body, headers=headers)
+                    if response.status_code < 500:
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 5))
+            else:
+                print(f"⚠️ 转发到工作进程 {index} 失败，丢弃更新")
+            queue.task_done()
+
+    async def drain(self):
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+
+
+class UpdateHandler(web.RequestHandler):
+    def initialize(self, router):
+        self.router = router
+
+    async def post(self):
+        token = self.request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, self.router.secret):
+            self.set_status(403)
+            return
+        try:
+            update = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        if self.router.stopping:
+            # 让 Telegram 稍后重试
+            self.set_status(503)
+            return
+        self.router.dispatch(update, self.request.body)
+        self.set_status(200)
+
+
+async def set_webhook(client, bot_token, url, secret):
+    response = await client.post(
+        f"https://api.telegram.org/bot{bot_token}/setWebhook",
+        json={"url": url, "secret_token": secret},
+    )
+    print("🔗 setWebhook:", response.json())
+
+
+async def run():
+    bot_token = os.getenv("BOT_TOKEN")
+    secret = os.getenv("WEBHOOK_SECRET")
+    if not bot_token or not secret:
+        print("❌ 错误：BOT_TOKEN 和 WEBHOOK_SECRET 必须设置")
+        return
+    path = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+    port = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT", "8443"))
+
+    router = ShardRouter(SHARD_WORKERS, SHARD_BASE_PORT, path, secret)
+    for index in range(router.workers):
+        router.spawn_worker(index)
+
+    client = httpx.AsyncClient(timeout=10)
+    forwarders = [asyncio.create_task(router.forward(i, client)) for i in range(router.workers)]
+    supervisor = asyncio.create_task(router.supervise())
+
+    app = web.Application([(rf"/{path}", UpdateHandler, {"router": router})])
+    server = httpserver.HTTPServer(app)
+    server.listen(port, address=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"))
+    print(f"🤖 分片路由已启动：{router.workers} 个工作进程，端口 {port}")
+
+    public_url = os.getenv("WEBHOOK_URL")
+    if public_url:
+        await set_webhook(client, bot_token, f"{public_url.rstrip('/')}/{path}", secret)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # 停止接收 → 转发完已接收的更新 → 通知工作进程处理完后退出
+    print("⏳ 分片路由正在退出")
+    router.stopping = True
+    server.stop()
+    try:
+        await asyncio.wait_for(router.drain(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print("⚠️ 等待转发超时，部分更新未转发")
+    supervisor.cancel()
+    for task in forwarders:
+        task.cancel()
+    for process in router.processes:
+        if process is not None and process.poll() is None:
+            process.terminate()
+    for process in router.processes:
+        if process is not None:
+            process.wait()
+    await client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
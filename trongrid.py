@@ -0,0 +1,114 @@
+import os
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from decimal import Decimal
+import httpx
+import metrics
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRONGRID_API_URL = os.getenv("TRONGRID_API_URL", "https://api.trongrid.io")
+TRON_API_KEY = os.getenv("TRONGRID_API_KEY")
+# USDT-TRC20 合约地址（按合约过滤，而不是只看 token symbol）
+USDT_CONTRACT = os.getenv("USDT_TRC20_CONTRACT", "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t")
+
+# 每页条数（TronGrid 上限 200）与单次轮询最多翻页数
+PAGE_LIMIT = 200
+MAX_PAGES = int(os.getenv("TRONGRID_MAX_PAGES", "50"))
+# 水位线回看窗口（毫秒），防止索引延迟漏掉边界附近的交易
+OVERLAP_MS = int(os.getenv("TRONGRID_OVERLAP_MS", "60000"))
+# 内存中记住的最近交易ID数量，用于回看窗口内去重
+RECENT_TXIDS = 5000
+
+# USDT 精度：1 USDT = 10^6 微单位
+MICRO_UNITS = 10**6
+
+# 解析后的转账：amount 为整数微 USDT，timestamp 为本地时间
+Transfer = namedtuple("Transfer", ["txid", "symbol", "to_address", "amount", "timestamp", "block_timestamp"])
+
+
+# 金额转换为整数微 USDT，避免浮点比较
+def to_micro(amount):
+    return int((Decimal(str(amount)) * MICRO_UNITS).to_integral_value())
+
+
+# 每笔交易只解析一次
+def parse_transfer(tx):
+    return Transfer(
+        txid=tx["transaction_id"],
+        symbol=tx.get("token_info", {}).get("symbol"),
+        to_address=tx["to"].lower(),
+        amount=int(tx["value"]),
+        timestamp=datetime.fromtimestamp(tx["block_timestamp"] / 1000),
+        block_timestamp=tx["block_timestamp"],
+    )
+
+
+# 增量拉取 TRC20 入账记录：长连接 + 水位线 + 分页
+class TronGridPoller:
+    def __init__(self, address, api_key=TRON_API_KEY, base_url=TRONGRID_API_URL):
+        self.address = address
+        self.base_url = base_url
+        self.headers = {"TRON-PRO-API-KEY": api_key} if api_key else {}
+        # 已处理到的最新 block_timestamp（毫秒）
+        self.watermark = None
+        self._recent = OrderedDict()
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, timeout=10)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # 拉取 since_ms 与水位线之后的全部新入账，解析为 Transfer 并按 block_timestamp 升序返回
+    async def fetch_new_transfers(self, since_ms):
+        min_ts = since_ms
+        if self.watermark is not None:
+            min_ts = max(min_ts, self.watermark - OVERLAP_MS)
+
+        params = {
+            "only_to": "true",
+            "contract_address": USDT_CONTRACT,
+            "order_by": "block_timestamp,asc",
+            "min_timestamp": min_ts,
+            "limit": PAGE_LIMIT,
+        }
+        client = self._get_client()
+        transfers = []
+        for _ in range(MAX_PAGES):
+            with metrics.timer("trongrid.fetch_page"):
+                response = await client.get(f"/v1/accounts/{self.address}/transactions/trc20", params=params)
+                response.raise_for_status()
+            body = response.json()
+            for tx in body.get("data", []):
+                try:
+                    transfer = parse_transfer(tx)
+                except (KeyError, TypeError, ValueError, AttributeError) as e:
+                    print("⚠️ 解析交易失败:", e)
+                    continue
+                if transfer.txid not in self._recent:
+                    transfers.append(transfer)
+            fingerprint = body.get("meta", {}).get("fingerprint")
+            if not fingerprint:
+                break
+            params["fingerprint"] = fingerprint
+        else:
+            # 剩余的交易留到下一轮，从水位线继续
+            print(f"⚠️ TronGrid 翻页达到上限 {MAX_PAGES} 页，剩余交易下轮继续拉取")
+        return transfers
+
+    # 交易处理完成后推进水位线；未确认处理的交易下轮会被重新拉取
+    def mark_processed(self, transfers):
+        for transfer in transfers:
+            self._recent[transfer.txid] = True
+            self._recent.move_to_end(transfer.txid)
+            if self.watermark is None or transfer.block_timestamp > self.watermark:
+                self.watermark = transfer.block_timestamp
+        while len(self._recent) > RECENT_TXIDS:
+            self._recent.popitem(last=False)
@@ -0,0 +1,54 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# 基类信号量的上限，实际并发由 UserOrderedUpdateProcessor._slots 控制
+UNLIMITED_UPDATES = 2**31 - 1
+
+
+# 并发处理不同用户的更新，同一用户的更新按到达顺序串行处理，
+# 保证 context.user_data 中的多步流程（转账、兑换、充值）不被打乱
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        # process_update 由基类固定实现（@final）：基类的并发上限放开，
+        # 在 do_process_update 里先按用户排队，再占用自己的并发名额，
+        # 避免同一用户的排队更新占满名额
+        super().__init__(UNLIMITED_UPDATES)
+        # 实际的并发上限，只用于 _slots
+        self.update_limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # 用户ID → [锁, 等待/持有该锁的更新数]
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = self._user_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _user_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None